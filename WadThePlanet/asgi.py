@@ -0,0 +1,18 @@
+"""
+ASGI config for WadThePlanet project.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+(ex. `uvicorn WadThePlanet.asgi:application`); see planet/asgi.py.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "WadThePlanet.settings")
+
+django.setup(set_prefix=False)
+
+from planet.asgi import ASGIHandler
+
+application = ASGIHandler()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+# ======================== SQLite backend ======================================
+# Django's SQLite backend, with two changes for serving many requests at once:
+# - New connections are set up with `settings.SQLITE_PRAGMAS` (WAL journal, etc.)
+# - Transactions start with BEGIN IMMEDIATE, which takes the write lock upfront
+#   (waiting up to `busy_timeout` for it), instead of a deferred BEGIN. With the
+#   latter, a transaction that reads and then writes (ex. `update_or_create()`,
+#   or `select_for_update()`, which SQLite ignores) fails at once with "database
+#   is locked" if another one wrote in the meantime, as SQLite cannot wait for a
+#   lock while holding a read snapshot that would then be stale.
+#   (Like `"transaction_mode": "IMMEDIATE"` in the OPTIONS of Django 5.1+)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
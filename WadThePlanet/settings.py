@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 
 import os
 from django.urls import reverse_lazy
+from WadThePlanet.database import database_from_env
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -50,8 +51,14 @@ INSTALLED_APPS = [
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 MIDDLEWARE = [
+    # Per-view latency/SQL/template metrics, exported at /metrics/ (see planet/metrics.py)
+    'planet.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # Sends the reads of GET requests to the read replica, if any (see planet/routers.py)
+    'planet.routers.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    # Answers conditional GETs with 304s (see planet/revisions.py)
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -63,7 +70,8 @@ ROOT_URLCONF = 'WadThePlanet.urls'
 AUTH_USER_MODEL = 'planet.PlanetUser'
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # (DjangoTemplates, recording render times; see planet/metrics.py)
+        'BACKEND': 'planet.metrics.InstrumentedTemplates',
         'DIRS': [TEMPLATE_DIR, ],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -80,15 +88,50 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'WadThePlanet.wsgi.application'
+# When served over ASGI (WadThePlanet/asgi.py), the number of threads running
+# views in each process (each may hold a database connection); request bodies
+# are received beforehand, and those of over ASGI_MAX_BODY_SIZE bytes rejected
+ASGI_THREADS = 32
 
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
+# Set DATABASE_URL to use another database (ex. PostgreSQL; see WadThePlanet/database.py)
 
 DATABASES = {
+    'default': database_from_env(os.environ, BASE_DIR),
+}
+# Set DATABASE_REPLICA_URL to read most pages from a replica of the database
+# (see planet/routers.py); unset it to run the tests, which set up their own
+if os.environ.get('DATABASE_REPLICA_URL'):
+    DATABASES['replica'] = database_from_env(os.environ, BASE_DIR, 'DATABASE_REPLICA_URL')
+DATABASE_ROUTERS = ['planet.routers.ReplicaRouter']
+REPLICA_DATABASE = 'replica'
+# For how long (in seconds) browsers read from the primary database after writing;
+# should exceed the replication lag, so that users see their own changes
+REPLICA_STICKY_SECONDS = 10
+
+# Set up on each new SQLite connection (see WadThePlanet/backends/sqlite3/base.py):
+# the WAL journal lets pages be read while ratings and textures are being written,
+# and only syncs to disk at checkpoints; writers (whose transactions take the
+# write lock upfront) wait up to `busy_timeout` milliseconds for each other;
+# reads go through a memory map of up to `mmap_size` bytes
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# NOTE: Use a shared cache (ex. memcached) when running multiple processes/nodes
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'wdp',
     }
 }
 
@@ -143,5 +186,73 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = MEDIA_DIR
 MEDIA_URL = '/media/'
+# How long (in seconds) browsers may cache immutable media: processed textures
+# and their thumbnails, which are stored by content hash (see `views.serve_media()`;
+# in production, the web server serving MEDIA_ROOT should send the same headers)
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Uploads of up to FILE_UPLOAD_MAX_MEMORY_SIZE bytes are kept in memory, larger
+# ones are streamed to temporary files; ImageUploadHandler checks the header of
+# uploaded images as they stream in (see planet/uploads.py)
+FILE_UPLOAD_HANDLERS = [
+    'planet.uploads.ImageUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+FILE_UPLOAD_MAX_MEMORY_SIZE = 512 * 1024
+# Maximum size (in bytes) of the non-file fields of a request
+DATA_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+# Maximum size (in bytes) and number of pixels of uploaded images
+UPLOAD_MAX_SIZE = 12 * 1024 * 1024
+UPLOAD_MAX_IMAGE_PIXELS = 4096 * 4096
+ASGI_MAX_BODY_SIZE = UPLOAD_MAX_SIZE + DATA_UPLOAD_MAX_MEMORY_SIZE
+
+# Number of worker processes that resize textures and generate their thumbnails
+# in the background (see planet/jobs.py); 0 processes them synchronously instead
+TEXTURE_WORKERS = os.cpu_count()
+# Number of worker processes that composite the tiles of editor saves (see planet/jobs.py),
+# apart from the texture jobs so that saves do not wait for them; 0 composites in the request's process
+COMPOSITE_WORKERS = os.cpu_count()
+
+# Textures are shared by content (see planet/storage.py); those (re)saved less than
+# this many seconds ago are never deleted, as a planet may be about to use them.
+# `manage.py gc_textures` deletes them later
+TEXTURE_GC_GRACE_PERIOD = 60
+
+# The main pages are cached for anonymous users (see planet/viewcache.py) in this
+# cache, for this many seconds. For a single node, a local-memory or file-based
+# ('django.core.cache.backends.filebased.FileBasedCache') cache will do
+VIEW_CACHE = 'default'
+VIEW_CACHE_TIMEOUT = 10 * 60
+
+# Number of planets/systems per leaderboard page
+LEADERBOARD_PAGE_SIZE = 25
+# If True, maintain a materialized ranking table (`planet.models.Ranking`) and
+# page through it when sorting the leaderboard by score
+LEADERBOARD_RANKING_TABLE = False
+# How many of the highest-scoring planets are kept in the cache (for the home
+# page's MVP planet, see planet/leaderboard.py), and for how long (in seconds)
+LEADERBOARD_TOP_PLANETS = 10
+LEADERBOARD_TOP_PLANETS_TIMEOUT = 60 * 60
+
+# Number of comments per page, on the pages of planets
+COMMENTS_PAGE_SIZE = 20
+
+# Number of planets/systems/users suggested while typing in the search box
+SEARCH_SUGGESTIONS_COUNT = 5
+# How long (in seconds) suggestions are kept in the server's and browsers' caches
+SEARCH_SUGGESTIONS_TIMEOUT = 60 * 60
+SEARCH_SUGGESTIONS_MAX_AGE = 60
+
+# Request metrics (see planet/metrics.py); /metrics/ is only shown to staff users
+# and to requests from INTERNAL_IPS (ex. the Prometheus server)
+METRICS_ENABLED = True
+INTERNAL_IPS = ['127.0.0.1']
+# Fraction of the requests to profile with cProfile (0 disables profiling); the
+# profiles of those slower than METRICS_PROFILE_SLOW seconds are saved to
+# METRICS_PROFILE_DIR
+METRICS_PROFILE_RATE = 0
+METRICS_PROFILE_SLOW = 0.5
+METRICS_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
 
 LOGIN_URL = reverse_lazy('login')
@@ -13,11 +13,11 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+import re
 from django.conf.urls import url
 from django.contrib import admin
 from django.conf.urls import include
 from django.conf import settings
-from django.conf.urls.static import static
 
 from planet import views
 
@@ -25,4 +25,10 @@ urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^', include('planet.urls')),
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+if settings.DEBUG:
+    # In production, the web server serves MEDIA_ROOT (with the same caching headers)
+    urlpatterns += [
+        url(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), views.serve_media),
+    ]
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from planet.models import Planet, PlanetUser, SolarSystem, Comment
+from planet.models import Planet, PlanetUser, SolarSystem, Comment, TextureJob
 #from planet.forms import CustomUserCreationForm
 
 # Register your models here.
@@ -8,3 +8,4 @@ admin.site.register(PlanetUser)
 admin.site.register(Planet)
 admin.site.register(SolarSystem)
 admin.site.register(Comment)
+admin.site.register(TextureJob)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import sys
+import tempfile
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, IO, List, Optional, Tuple
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+
+
+# ======================== ASGI ================================================
+# Serves the site over ASGI (ex. `uvicorn WadThePlanet.asgi:application`), so
+# that a single process can hold many slow requests at once: request bodies
+# (ex. texture uploads from the editor) are received, and responses are sent,
+# on the event loop, without tying up a thread while they are in transit.
+# Django 2.2 cannot run views asynchronously, so the views (and middleware)
+# then run in a pool of `settings.ASGI_THREADS` threads, through the WSGI
+# handler; each holds a thread (and a DB connection) only while it runs. The
+# image work of editor saves runs in a process pool (see planet/jobs.py).
+
+logger = logging.getLogger(__name__)
+
+Scope = Dict
+Receive = Callable[[], Awaitable[Dict]]
+Send = Callable[[Dict], Awaitable[None]]
+
+
+class ASGIHandler:
+    '''ASGI (3.0) application running Django's WSGI handler in a thread pool, once
+    the whole request body has been received (spooled to a temporary file if
+    larger than `settings.FILE_UPLOAD_MAX_MEMORY_SIZE`). Requests of over
+    `settings.ASGI_MAX_BODY_SIZE` bytes are rejected as they come in.'''
+
+    def __init__(self, executor: Optional[Executor] = None):
+        self.wsgi_handler = WSGIHandler()
+        self.executor = executor if executor is not None else \
+            ThreadPoolExecutor(max_workers=settings.ASGI_THREADS, thread_name_prefix='asgi')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+    async def run(self, func: Callable, *args):
+        '''Runs `func(*args)` in the thread pool.'''
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def handle_lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                from planet import jobs
+                # (Waits for the queued texture jobs)
+                await self.run(jobs.shutdown_executor)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope: Scope, receive: Receive, send: Send):
+        body = await self.receive_body(scope, receive, send)
+        if body is None:
+            return  # (Rejected, or the client went away)
+        try:
+            status_headers = []
+
+            def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+                status_headers[:] = [int(status.split(' ', 1)[0]), headers]
+
+            response = await self.run(self.wsgi_handler, self.get_environ(scope, body), start_response)
+        finally:
+            body.close()
+
+        try:
+            status, headers = status_headers
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+            })
+            if not response.streaming:
+                await send({'type': 'http.response.body', 'body': response.content})
+                return
+            # (Streaming responses, ex. media files, are read in the thread pool)
+            chunks = iter(response)
+            chunk = await self.run(next, chunks, None)
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run(next, chunks, None)
+            await send({'type': 'http.response.body'})
+        finally:
+            # (Sends `request_finished`, which closes the DB connections past their age)
+            await self.run(response.close)
+
+    async def receive_body(self, scope: Scope, receive: Receive, send: Send) -> Optional[IO]:
+        '''Receives the body of the request; returns it as a file, or None if the
+        request was rejected for being too large (or the client disconnected).'''
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > settings.ASGI_MAX_BODY_SIZE:
+                await self.send_too_large(send)
+                return None
+
+        body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > settings.ASGI_MAX_BODY_SIZE:
+                body.close()
+                await self.send_too_large(send)
+                return None
+            body.write(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body
+
+    async def send_too_large(self, send: Send):
+        logger.info(f'Rejected request of over {settings.ASGI_MAX_BODY_SIZE} bytes')
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+        await send({'type': 'http.response.body', 'body': b'Request too large'})
+
+    def get_environ(self, scope: Scope, body: IO) -> Dict:
+        '''Returns the WSGI environ for the request `scope`, with `body` as input.'''
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        body.seek(0, 2)
+        content_length = body.tell()
+        body.seek(0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # (WSGI strings are bytes decoded as latin-1)
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port or 80),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'CONTENT_LENGTH': str(content_length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name == 'CONTENT_LENGTH':
+                continue  # (Set from the body received)
+            if name != 'CONTENT_TYPE':
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+            environ[name] = value
+        return environ
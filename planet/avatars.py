@@ -0,0 +1,90 @@
+import io
+import logging
+import os
+from typing import IO
+from PIL import Image, ImageOps
+from django.conf import settings
+from planet.metrics import timed
+
+
+# ======================== Avatars =============================================
+# Uploaded avatars are normalized when a user is saved (see `PlanetUser.save()`):
+# center-cropped to a square and re-encoded as a `AVATAR_SIZE`x`AVATAR_SIZE`
+# JPEG, which is what the avatar field stores. Smaller variants (`AVATAR_VARIANT_SIZES`)
+# are generated next to it, for the pages showing many avatars at once (ex. the
+# comments of a planet). Avatars uploaded before this are converted by
+# `manage.py process_avatars`; until then, their pages use the original file.
+
+logger = logging.getLogger(__name__)
+
+AVATAR_DIR = 'avatars'
+'''Directory (relative to MEDIA_ROOT) where the normalized avatars are stored.'''
+
+AVATAR_SIZE = 256
+'''Size (in pixels, square) of the normalized avatars; shown on user and system pages.'''
+
+AVATAR_VARIANT_SIZES = (96,)
+'''Sizes (in pixels, square) of the smaller variants of each avatar; shown next
+to comments, in the header and in search results (at 45-48px, or twice that
+on high-DPI screens).'''
+
+
+def is_normalized(avatar_name: str) -> bool:
+    '''Returns True if the avatar named `avatar_name` was normalized (and hence
+    has variants). Only looks at the name, so that templates can call it freely.'''
+    return avatar_name.startswith(AVATAR_DIR + '/')
+
+
+def variant_name(avatar_name: str, size: int) -> str:
+    '''Returns the name (relative to MEDIA_ROOT) of the `size`x`size` variant of
+    the avatar named `avatar_name`.'''
+    return os.path.join(AVATAR_DIR, str(size), os.path.basename(avatar_name))
+
+
+def variant_path(avatar_name: str, size: int) -> str:
+    '''Like `variant_name()`, but returns an absolute path on disk.'''
+    return os.path.join(settings.MEDIA_ROOT, variant_name(avatar_name, size))
+
+
+@timed('normalize_avatar')
+def normalize_avatar(f: IO) -> bytes:
+    '''Center-crops the uploaded image `f` (validated by `uploads.validate_avatar()`)
+    to a square and scales it to `AVATAR_SIZE`; returns it JPEG-encoded.'''
+    f.seek(0)
+    with Image.open(f) as pil_img:
+        # For JPEGs, let the decoder do most of the downscaling for us (DCT scaling)
+        pil_img.draft('RGB', (AVATAR_SIZE, AVATAR_SIZE))
+        if pil_img.mode in ('RGBA', 'LA', 'P'):
+            # Flatten any transparency on white
+            rgba = pil_img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[3])
+        else:
+            img = pil_img.convert('RGB')
+
+    img = ImageOps.fit(img, (AVATAR_SIZE, AVATAR_SIZE), method=Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=85, optimize=True)
+    return out.getvalue()
+
+
+@timed('generate_avatar_variants')
+def generate_variants(avatar_name: str):
+    '''(Re)generates the variants of the (normalized) avatar named `avatar_name`.'''
+    with Image.open(os.path.join(settings.MEDIA_ROOT, avatar_name)) as pil_img:
+        img = pil_img.convert('RGB')
+    for size in sorted(AVATAR_VARIANT_SIZES, reverse=True):
+        img = img.resize((size, size), resample=Image.LANCZOS)
+        dest_path = variant_path(avatar_name, size)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        img.save(dest_path, 'JPEG', quality=85, optimize=True)
+    logger.debug(f'{avatar_name}: generated variants {sorted(AVATAR_VARIANT_SIZES)}')
+
+
+def delete_variants(avatar_name: str):
+    '''Deletes the variants of the avatar named `avatar_name` (if any).'''
+    for size in AVATAR_VARIANT_SIZES:
+        try:
+            os.remove(variant_path(avatar_name, size))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,44 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    '''A small, thread-safe, in-process least-recently-used cache.'''
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        '''Returns the value for `key` (marking it as recently used), or `default`.'''
+        with self._lock:
+            value = self._entries.get(key, self._MISSING)
+            if value is self._MISSING:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        '''Sets the value for `key`, evicting the least recently used entry if full.'''
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        '''Removes `key` from the cache (if present).'''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''Removes all entries from the cache.'''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
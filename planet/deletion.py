@@ -0,0 +1,105 @@
+from django.db import connections, router, transaction
+from django.db.models import F, OuterRef, Q, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from planet.models import Planet, SolarSystem, PlanetUser, Comment, TextureJob
+from planet import jobs, leaderboard, resolvers, scores, viewcache, webhose_search
+
+
+# ======================== Cascade delete ======================================
+# Deleting planets one by one with `Planet.delete()` costs a score update and a
+# round of signal handlers (rankings, search index, django-cleanup) per planet.
+# The functions below delete whole users/solar systems in a fixed number of
+# set-based statements inside a single transaction instead, doing the work of
+# those signal handlers in bulk; texture files are deleted in one batch, after
+# the transaction commits.
+
+
+def _delete_rows(ids: QuerySet) -> int:
+    '''Deletes the rows whose ids are selected by `ids` (a `values('id')` queryset)
+    with a single plain DELETE statement, using it as a subquery; without sending
+    signals or cascading, so the rows referring to them must be deleted first.'''
+    model = ids.model
+    connection = connections[router.db_for_write(model)]
+    subquery, params = ids.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)} '
+                       f'WHERE {connection.ops.quote_name(model._meta.pk.column)} IN ({subquery})', params)
+        return cursor.rowcount
+
+
+def _total(queryset: QuerySet, group_by: str, field: str) -> Coalesce:
+    '''An expression summing `field` over the rows of `queryset` whose `group_by`
+    matches the outer row; for use in UPDATEs.'''
+    return Coalesce(Subquery(queryset.filter(**{group_by: OuterRef('pk')})
+                             .values(group_by).annotate(total=Sum(field)).values('total')), 0)
+
+
+def cascade_delete(planets: Q, systems: Q, comments: Q = Q(pk__in=[])) -> int:
+    '''Deletes the planets matching `planets`, the solar systems matching `systems`
+    (along with all their planets) and the comments matching `comments` (along
+    with all comments on deleted planets), updating the scores of what remains.
+    Returns the number of deleted planets.'''
+    with transaction.atomic():
+        planets = Planet.objects.filter(planets | Q(solarSystem__in=SolarSystem.objects.filter(systems)))
+        planet_ids, texture_names = list(zip(*planets.values_list('id', 'texture'))) or ([], [])
+        system_ids = list(SolarSystem.objects.filter(systems).values_list('id', flat=True))
+        planets = Planet.objects.filter(id__in=planets.values('id'))  # (Subquery, as ids may be many)
+
+        # Surviving planets (and their systems) lose the ratings of deleted comments,
+        # which also leave the planets' comment summaries;
+        # surviving systems lose the scores of their deleted planets
+        ratings = Comment.objects.filter(comments).exclude(planet__in=planets)
+        rated_planets = Planet.objects.filter(id__in=ratings.values('planet'))
+        affected_systems = SolarSystem.objects.filter(
+            Q(id__in=planets.values('solarSystem')) | Q(id__in=rated_planets.values('solarSystem'))) \
+            .exclude(systems)
+        rated_planet_ids = list(rated_planets.values_list('id', flat=True))
+        affected_system_ids = list(affected_systems.values_list('id', flat=True))
+        page_tags = viewcache.planet_queryset_tags(
+            Planet.objects.filter(Q(id__in=planets.values('id')) | Q(id__in=rated_planet_ids)))
+        page_tags += [tag for system in SolarSystem.objects.filter(systems).select_related('user')
+                      for tag in viewcache.system_tags(system)]
+        now = timezone.now()
+        rated_planets.update(score=F('score') - _total(ratings, 'planet', 'rating'),
+                             **{field: F(field) - count for field, count in scores.comment_summary(ratings).items()},
+                             revision=F('revision') + 1, modified=now)
+        affected_systems.update(score=F('score') - _total(planets, 'solarSystem', 'score')
+                                              - _total(ratings, 'planet__solarSystem', 'rating'),
+                                revision=F('revision') + 1, modified=now)
+        # (The pages of the users of deleted/rated planets and of the owners of their systems)
+        PlanetUser.objects.filter(Q(id__in=planets.values('user')) | Q(id__in=rated_planets.values('user'))
+                                  | Q(id__in=affected_systems.values('user'))) \
+            .update(revision=F('revision') + 1, modified=now)
+
+        # Delete children first
+        _delete_rows(Comment.objects.filter(comments | Q(planet__in=planets)).values('id'))
+        _delete_rows(TextureJob.objects.filter(planet__in=planets).values('id'))
+        leaderboard.remove_rankings(Planet, planets.values_list('id', flat=True))
+        _delete_rows(planets.values('id'))
+        leaderboard.remove_rankings(SolarSystem, system_ids)
+        _delete_rows(SolarSystem.objects.filter(systems).values('id'))
+
+        leaderboard.refresh_planet_rankings(rated_planet_ids)
+        leaderboard.refresh_rankings(SolarSystem, affected_system_ids)
+        webhose_search.remove_ids_from_index(Planet, planet_ids)
+        webhose_search.remove_ids_from_index(SolarSystem, system_ids)
+        webhose_search.invalidate_suggestions()
+        viewcache.invalidate(*page_tags)
+        resolvers.invalidate()
+        jobs.enqueue_texture_cleanup(texture_names)
+    return len(planet_ids)
+
+
+def delete_system(system: SolarSystem):
+    '''Deletes `system` and all planets in it (even if they are by other users).'''
+    cascade_delete(planets=Q(pk__in=[]), systems=Q(id=system.id))
+
+
+def delete_user(user: PlanetUser):
+    '''Deletes `user`, his planets, comments and solar systems, and all planets
+    in his solar systems (even if they are by other users).'''
+    with transaction.atomic():
+        cascade_delete(planets=Q(user=user), systems=Q(user=user), comments=Q(user=user))
+        # Nothing refers to the user anymore; this also lets django-cleanup delete his avatar
+        user.delete()
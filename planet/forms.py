@@ -7,6 +7,19 @@ from crispy_forms.helper import FormHelper
 from crispy_forms.layout import *
 from crispy_forms.bootstrap import FormActions
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from planet.texturegen import generate_planet_texture_jpeg
+from planet.uploads import validate_avatar
+
+
+class AvatarField(forms.ImageField):
+    '''An ImageField checking the header of the uploaded image (see
+    planet/uploads.py) before Pillow opens and verifies the whole image.'''
+
+    def to_python(self, data):
+        if data:
+            validate_avatar(data)
+        return super().to_python(data)
 
 
 class RegistrationForm(forms.ModelForm):
@@ -16,6 +29,7 @@ class RegistrationForm(forms.ModelForm):
             help_text=('Required. 32 characters or fewer. Letters and digits only. Excludes some reserved words.'))
     password_copy = forms.CharField(
         label='Confirm password', min_length=6, max_length=128, widget=forms.PasswordInput)
+    avatar = AvatarField(required=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -188,16 +202,9 @@ class PlanetForm(forms.ModelForm):
             )
         )
 
-    def generate_texture(self, name):
-        img = Image.new('RGB', (2048, 2048), (
-            random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-
-        self_path=os.path.dirname(os.path.abspath(os.path.join(__file__, '..')))
-
-        rel_dest_path = os.path.join('planets', name + '.jpg')  # Relative to /media
-        abs_dest_path = os.path.join(self_path, 'media', rel_dest_path)
-        img.save(abs_dest_path, 'JPEG')
-        return rel_dest_path
+    def generate_texture(self) -> ContentFile:
+        '''Generates a random texture for a new planet; save it with `planet.texture.save()`.'''
+        return ContentFile(generate_planet_texture_jpeg(Planet.TEXTURE_SIZE))
 
 
 class EditUserForm(forms.Form):
@@ -210,8 +217,8 @@ class EditUserForm(forms.Form):
                                widget=forms.PasswordInput, required=False)
     password_copy = forms.CharField(label='Confirm changed password', min_length=6, max_length=128,
                                     widget=forms.PasswordInput, required=False)
-    avatar = forms.ImageField(label='Change avatar',
-                              required=False)
+    avatar = AvatarField(label='Change avatar',
+                         required=False)
 
     def __init__(self, *args, user_id, **kwargs):
         super().__init__(*args, **kwargs)
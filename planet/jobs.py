@@ -0,0 +1,206 @@
+import functools
+import io
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from planet.models import Planet, TextureJob
+from planet import metrics, revisions, textures, viewcache
+from planet.storage import texture_storage
+
+
+# ======================== Utilities ===========================================
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+'''The process pool running the texture jobs; see `get_executor()`.'''
+
+_composite_executor = None
+'''The process pool compositing the tiles of editor saves; see `get_composite_executor()`.'''
+
+_cleanup_retries = set()
+'''The names of the textures whose deletion is to be retried; see `retry_texture_cleanup()`.'''
+
+_cleanup_timer = None
+'''The timer thread draining `_cleanup_retries`, if any is pending.'''
+
+_cleanup_lock = threading.Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    '''Returns the (lazily-created) process pool that runs texture jobs.'''
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.TEXTURE_WORKERS)
+    return _executor
+
+
+def get_composite_executor() -> ProcessPoolExecutor:
+    '''Returns the (lazily-created) process pool that composites editor saves;
+    separate from the texture jobs', so that saves (which the editor waits
+    for) do not queue behind them.'''
+    global _composite_executor
+    if _composite_executor is None:
+        _composite_executor = ProcessPoolExecutor(max_workers=settings.COMPOSITE_WORKERS)
+    return _composite_executor
+
+
+def shutdown_executor():
+    '''Waits for the submitted texture jobs (and composites) to finish, then shuts
+    down the process pools (new ones are created for the next job).'''
+    global _executor, _composite_executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    if _composite_executor is not None:
+        _composite_executor.shutdown(wait=True)
+        _composite_executor = None
+
+
+# ======================== Jobs ================================================
+
+
+def enqueue_texture_job(planet: Planet) -> TextureJob:
+    '''Queues a job to process `planet`'s current texture.
+    The job is submitted to the process pool once the current transaction
+    commits, or run synchronously if `settings.TEXTURE_WORKERS` is 0.'''
+    job = TextureJob.objects.create(planet=planet, texture=planet.texture.name)
+    if settings.TEXTURE_WORKERS:
+        transaction.on_commit(lambda: submit_job(job))
+    else:
+        run_job(job)
+    return job
+
+
+def submit_job(job: TextureJob) -> Future:
+    '''Submits `job` to the process pool; returns the corresponding future.'''
+    TextureJob.objects.filter(id=job.id).update(state=TextureJob.RUNNING, updated=timezone.now())
+    future = get_executor().submit(textures.process_texture, job.texture, Planet.TEXTURE_SIZE)
+    future.add_done_callback(functools.partial(_on_job_done, job.id, threading.get_ident()))
+    return future
+
+
+def _on_job_done(job_id: int, submitter_ident: int, future: Future):
+    # Usually runs in one of the pool's threads, which gets its own DB connection;
+    # close it when done (unless we are still in the thread that submitted the job)
+    try:
+        if future.exception() is None:
+            metrics.observe('wdp_image_processing_seconds', future.result(), operation='process_texture')
+        finish_job(job_id, future.exception())
+    finally:
+        if threading.get_ident() != submitter_ident:
+            connection.close()
+
+
+def run_job(job: TextureJob):
+    '''Runs `job` synchronously, in this process.'''
+    try:
+        elapsed = textures.process_texture(job.texture, Planet.TEXTURE_SIZE)
+        metrics.observe('wdp_image_processing_seconds', elapsed, operation='process_texture')
+        error = None
+    except Exception as e:
+        error = e
+    finish_job(job.id, error)
+
+
+def finish_job(job_id: int, error: Optional[BaseException]):
+    '''Marks the job as done (or failed, if `error` is set) and updates the
+    processing state of its planet.'''
+    planet_id = TextureJob.objects.filter(id=job_id).values_list('planet_id', flat=True).first()
+    if planet_id is None:
+        return  # The planet (and hence the job) was deleted meanwhile
+
+    if error is not None:
+        logger.error(f'TextureJob{job_id}: processing failed: {repr(error)}')
+        TextureJob.objects.filter(id=job_id).update(
+            state=TextureJob.FAILED, error=repr(error), updated=timezone.now())
+        # NOTE: The planet stays in the processing state; its lists will keep
+        #       showing the full texture until the job is retried
+        return
+
+    TextureJob.objects.filter(id=job_id).update(state=TextureJob.DONE, updated=timezone.now())
+    # Leave the planet in the processing state if other jobs are still queued for it
+    if Planet.objects.filter(id=planet_id).exclude(
+            texturejob__state__in=[TextureJob.PENDING, TextureJob.RUNNING]).update(processing=False):
+        # The cached pages still show the planet as processing
+        viewcache.invalidate(*viewcache.planet_queryset_tags(Planet.objects.filter(id=planet_id)))
+        revisions.bump(Planet, [planet_id])
+        revisions.bump_around_planets([planet_id])
+    logger.debug(f'TextureJob{job_id}: done')
+
+
+# ======================== Editor saves ========================================
+
+
+def composite_tiles(texture_name: str, tiles: List[Tuple[int, int, bytes]]) -> bytes:
+    '''Runs `textures.composite_tiles()` for the given `(x, y, JPEG data)` tiles in
+    the composite process pool and waits for its result, so that concurrent
+    editor saves do not compete for this process (its GIL); or runs it here if
+    `settings.COMPOSITE_WORKERS` is 0. Raises ValueError on invalid tiles.'''
+    tile_files = [(x, y, io.BytesIO(data)) for x, y, data in tiles]
+    if not settings.COMPOSITE_WORKERS:
+        return textures.composite_tiles(texture_name, tile_files, Planet.TEXTURE_SIZE, Planet.TEXTURE_TILE_SIZE)
+    # (Timed here too, as the metrics recorded by the worker process are lost)
+    with metrics.timed('composite_tiles'):
+        return get_composite_executor().submit(textures.composite_tiles, texture_name, tile_files,
+                                               Planet.TEXTURE_SIZE, Planet.TEXTURE_TILE_SIZE).result()
+
+
+# ======================== File cleanup ========================================
+
+
+def enqueue_texture_cleanup(texture_names: List[str]):
+    '''Deletes the given texture files (and their derivatives) in a single batch
+    once the current transaction commits, if no other planet uses them (see
+    planet/storage.py); in the process pool, unless `settings.TEXTURE_WORKERS`
+    is 0. Used when deleting planets in bulk, which bypasses django-cleanup.'''
+    if not texture_names:
+        return
+
+    def cleanup():
+        unused = texture_storage.collectable(texture_names)
+        # (Checking the age again just before deleting, as in `TextureStorage.delete()`)
+        if settings.TEXTURE_WORKERS:
+            get_executor().submit(textures.delete_textures, unused, settings.TEXTURE_GC_GRACE_PERIOD)
+        else:
+            textures.delete_textures(unused, settings.TEXTURE_GC_GRACE_PERIOD)
+        # Those too recent (or still referenced) are retried after the grace period
+        retried = set(texture_names) - set(unused)
+        if retried:
+            retry_texture_cleanup(retried)
+    transaction.on_commit(cleanup)
+
+
+def retry_texture_cleanup(texture_names: Iterable[str]):
+    '''Queues the given texture files to be deleted with `TextureStorage.delete()`
+    (hence only if they are unused and old enough by then) once the grace period
+    is over. A single timer thread drains the queue, re-queueing those still too
+    recent; textures left behind if the process exits meanwhile are deleted by
+    `manage.py gc_textures`.'''
+    global _cleanup_timer
+    with _cleanup_lock:
+        _cleanup_retries.update(texture_names)
+        if _cleanup_timer is None:
+            _cleanup_timer = threading.Timer(settings.TEXTURE_GC_GRACE_PERIOD, _drain_cleanup_retries)
+            _cleanup_timer.daemon = True  # (Do not hold up the exit of the process)
+            _cleanup_timer.start()
+
+
+def _drain_cleanup_retries():
+    global _cleanup_timer
+    with _cleanup_lock:
+        texture_names = list(_cleanup_retries)
+        _cleanup_retries.clear()
+        _cleanup_timer = None
+    try:
+        for name in texture_names:
+            try:
+                texture_storage.delete(name)
+            except Exception:
+                logger.exception(f'{name}: could not delete it')
+    finally:
+        connection.close()  # (The timer thread's own connection)
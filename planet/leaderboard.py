@@ -0,0 +1,238 @@
+import base64
+import binascii
+import json
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Model, Q, QuerySet
+from planet.models import Planet, SolarSystem, Ranking
+from planet.routers import use_primary
+
+
+# ======================== Keyset pagination ===================================
+
+SORTS = {
+    'score': ('-score', '-id'),
+    'id': ('-id',),
+    'name': ('name', 'id'),
+}
+'''Sort criteria (as chosen in `LeaderboardForm`) => the fields to order by.
+The last field must be unique, so that the order is total.'''
+
+
+def encode_cursor(values: Sequence) -> str:
+    '''Encodes the ordering values of the last row of a page to an opaque cursor.'''
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List:
+    '''Inverse of `encode_cursor()`. Raises ValueError on malformed cursors.'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, UnicodeError, json.JSONDecodeError, binascii.Error):
+        raise ValueError(f'Malformed cursor: {cursor}')
+    if not isinstance(values, list):
+        raise ValueError(f'Malformed cursor: {cursor}')
+    return values
+
+
+def keyset_filter(order: Sequence[str], values: Sequence) -> Q:
+    '''Returns a filter selecting the rows that come after `values` when ordering
+    by `order`; for `order=('-score', '-id')` it is equivalent to
+    `score <= s AND (score < s OR id < i)`, which lets the DB seek into the index.'''
+    field, *other_fields = order
+    name = field.lstrip('-')
+    lookup = 'lt' if field.startswith('-') else 'gt'
+    after = Q(**{f'{name}__{lookup}': values[0]})
+    if not other_fields:
+        return after
+    return Q(**{f'{name}__{lookup}e': values[0]}) & (after | keyset_filter(other_fields, values[1:]))
+
+
+def keyset_page(queryset: QuerySet, order: Sequence[str], cursor: Optional[str],
+                page_size: int) -> Tuple[List, Optional[str]]:
+    '''Gets the page of `queryset` (ordered by `order`) that starts after `cursor`;
+    returns `(rows, next_cursor)`, where `next_cursor` is None on the last page.
+    Raises ValueError if `cursor` is malformed.'''
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(order):
+            raise ValueError(f'Malformed cursor: {cursor}')
+        queryset = queryset.filter(keyset_filter(order, values))
+
+    rows = list(queryset.order_by(*order)[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, field.lstrip('-')) for field in order])
+
+
+def leaderboard_page(queryset: QuerySet, sort: str, cursor: Optional[str],
+                     page_size: int = None) -> Tuple[List, Optional[str]]:
+    '''Gets a page of the leaderboard for the (planet or solar system) `queryset`,
+    sorted by the `sort` criteria (a key of `SORTS`) and starting after `cursor`.
+    Returns `(rows, next_cursor)`. Raises ValueError if `cursor` is malformed.
+
+    If `settings.LEADERBOARD_RANKING_TABLE` is set, the pages sorted by score are
+    read from the `Ranking` table instead, then their rows are fetched by id.'''
+    page_size = page_size or settings.LEADERBOARD_PAGE_SIZE
+    if sort != 'score' or not settings.LEADERBOARD_RANKING_TABLE:
+        return keyset_page(queryset, SORTS[sort], cursor, page_size)
+
+    entries = Ranking.objects.filter(kind=Ranking.kind_of(queryset.model))
+    entries, next_cursor = keyset_page(entries, ('-score', '-object_id'), cursor, page_size)
+    rows = queryset.in_bulk([entry.object_id for entry in entries])
+    return [rows[entry.object_id] for entry in entries if entry.object_id in rows], next_cursor
+
+
+# ======================== Ranking table =======================================
+
+
+def refresh_rankings(model: 'Model', ids: Iterable[int]):
+    '''Refreshes the `Ranking` entries of the objects of `model` with the given ids
+    (adding, updating or removing them as needed). No-op if the ranking table is
+    disabled in settings.'''
+    ids = list(ids)
+    if model is Planet:
+        # (Once committed: the top planets are shared, and the transaction may still roll back)
+        transaction.on_commit(lambda: refresh_top_planets(ids))
+    if not settings.LEADERBOARD_RANKING_TABLE:
+        return
+    kind = Ranking.kind_of(model)
+    with transaction.atomic():
+        Ranking.objects.filter(kind=kind, object_id__in=ids).delete()
+        visible = model.objects.filter(id__in=ids, visibility=True).values_list('id', 'score')
+        Ranking.objects.bulk_create(
+            [Ranking(kind=kind, object_id=id, score=score) for id, score in visible])
+
+
+def remove_rankings(model: 'Model', ids: Iterable[int]):
+    '''Removes the `Ranking` entries of the objects of `model` with the given ids
+    (which may also be a `values_list()` queryset, to use a subquery).
+    No-op if the ranking table is disabled in settings.'''
+    if not isinstance(ids, QuerySet):
+        ids = list(ids)
+    if model is Planet:
+        # (Once committed, as above; a queryset of ids just invalidates them)
+        transaction.on_commit(lambda: remove_top_planets(ids))
+    if not settings.LEADERBOARD_RANKING_TABLE:
+        return
+    Ranking.objects.filter(kind=Ranking.kind_of(model), object_id__in=ids).delete()
+
+
+def refresh_planet_rankings(planet_ids: Iterable[int]):
+    '''Like `refresh_rankings()`, for the given planets and their solar systems.'''
+    planet_ids = list(planet_ids)
+    refresh_rankings(Planet, planet_ids)
+    if not settings.LEADERBOARD_RANKING_TABLE:
+        return
+    refresh_rankings(SolarSystem, Planet.objects.filter(id__in=planet_ids)
+                     .values_list('solarSystem_id', flat=True).distinct())
+
+
+def rebuild_rankings():
+    '''Rebuilds the whole `Ranking` table from scratch. No-op if the ranking
+    table is disabled in settings (the top planets are rebuilt regardless).'''
+    invalidate_top_planets()
+    if not settings.LEADERBOARD_RANKING_TABLE:
+        return
+    with transaction.atomic():
+        Ranking.objects.all().delete()
+        for model in (Planet, SolarSystem):
+            kind = Ranking.kind_of(model)
+            visible = model.objects.filter(visibility=True).values_list('id', 'score')
+            Ranking.objects.bulk_create(
+                [Ranking(kind=kind, object_id=id, score=score) for id, score in visible.iterator()],
+                batch_size=500)
+
+
+# ======================== Top planets =========================================
+# The ids and scores of the (visible) planets with the highest scores are kept in
+# the shared cache, best first, so that the home page can show the MVP planet
+# without sorting the planets table. The list is rebuilt (one query on the
+# leaderboard's index) when missing, and otherwise updated incrementally by the
+# functions above, which are called on every score/visibility change; once the
+# change commits, so that the list never holds scores that were rolled back.
+# The list is always an exact prefix of the ranking: a listed planet whose score
+# drops below the last listed one is dropped (as whatever comes after it is
+# unknown), and the list is rebuilt once it runs out. (Concurrent updates from
+# different processes may still race; the list then expires after
+# `settings.LEADERBOARD_TOP_PLANETS_TIMEOUT` seconds.)
+
+TOP_PLANETS_KEY = 'leaderboard-top-planets'
+'''The (shared) cache key of the top planets.'''
+
+
+def _top_sort_key(entry: Tuple[int, int]) -> Tuple[int, int]:
+    score, id = entry
+    return -score, -id  # (Same order as `SORTS['score']`)
+
+
+def _load_top_planets() -> dict:
+    top = cache.get(TOP_PLANETS_KEY)
+    if top is None:
+        count = settings.LEADERBOARD_TOP_PLANETS
+        # (From the primary database, as the list is shared and updated incrementally)
+        with use_primary():
+            entries = list(Planet.objects.filter(visibility=True).order_by('-score', '-id')
+                           .values_list('score', 'id')[:count])
+        # `complete`: all visible planets are listed (so any planet can be inserted)
+        top = {'entries': entries, 'complete': len(entries) < count}
+        cache.set(TOP_PLANETS_KEY, top, settings.LEADERBOARD_TOP_PLANETS_TIMEOUT)
+    return top
+
+
+def _store_top_planets(top: dict):
+    if not top['entries'] and not top['complete']:
+        cache.delete(TOP_PLANETS_KEY)  # Ran out; rebuild it on the next read
+    else:
+        cache.set(TOP_PLANETS_KEY, top, settings.LEADERBOARD_TOP_PLANETS_TIMEOUT)
+
+
+def top_planet_ids() -> List[int]:
+    '''Returns the ids of the visible planets with the highest scores, best first
+    (at most `settings.LEADERBOARD_TOP_PLANETS`, but possibly fewer).'''
+    return [id for score, id in _load_top_planets()['entries']]
+
+
+def refresh_top_planets(planet_ids: Iterable[int]):
+    '''Updates the top planets with the current score and visibility of the
+    planets with the given ids (one query, unless the top planets are not cached).'''
+    top = cache.get(TOP_PLANETS_KEY)
+    if top is None or not planet_ids:
+        return
+    with use_primary():
+        rows = list(Planet.objects.filter(id__in=planet_ids).values_list('id', 'score', 'visibility'))
+    entries = top['entries']
+    for id, score, visible in rows:
+        entries = [entry for entry in entries if entry[1] != id]
+        entry = (score, id)
+        if visible and (top['complete'] or (entries and _top_sort_key(entry) < _top_sort_key(entries[-1]))):
+            entries.append(entry)
+            entries.sort(key=_top_sort_key)
+    if len(entries) > settings.LEADERBOARD_TOP_PLANETS:
+        entries = entries[:settings.LEADERBOARD_TOP_PLANETS]
+        top['complete'] = False
+    top['entries'] = entries
+    _store_top_planets(top)
+
+
+def remove_top_planets(planet_ids: Union[Iterable[int], QuerySet]):
+    '''Removes the planets with the given ids from the top planets. If `planet_ids`
+    is a (`values_list()`) queryset, as for bulk deletes, the top planets are
+    simply invalidated instead.'''
+    if isinstance(planet_ids, QuerySet):
+        invalidate_top_planets()
+        return
+    top = cache.get(TOP_PLANETS_KEY)
+    removed = set(planet_ids)
+    if top is not None and removed.intersection(id for score, id in top['entries']):
+        top['entries'] = [entry for entry in top['entries'] if entry[1] not in removed]
+        _store_top_planets(top)
+
+
+def invalidate_top_planets():
+    '''Forgets the top planets; they are rebuilt on the next read.'''
+    cache.delete(TOP_PLANETS_KEY)
@@ -0,0 +1,290 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+import django
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, F
+from django.test import Client, override_settings
+from django.urls import reverse
+from planet import jobs
+from planet.models import Planet, PlanetUser, SolarSystem, Comment
+
+
+# ======================== Scenarios ===========================================
+# Each scenario returns the (method, URL, POST data) of a random request, given
+# a random generator and the dataset (see `load_dataset()`); POST requests are
+# made by a logged-in user, owning the planets of `dataset['own_planets']`.
+
+Request = Tuple[str, str, Dict]
+
+
+def home(rng: random.Random, dataset: Dict) -> Request:
+    return 'GET', reverse('home'), {}
+
+
+def leaderboard(rng: random.Random, dataset: Dict) -> Request:
+    return 'GET', reverse('leaderboard') + '?choice=' + rng.choice(['score', 'name']), {}
+
+
+def search(rng: random.Random, dataset: Dict) -> Request:
+    word = rng.choice(dataset['words'])
+    return 'GET', reverse('search') + '?query=' + word[:rng.randint(2, len(word))], {}
+
+
+def view_planet(rng: random.Random, dataset: Dict) -> Request:
+    return 'GET', reverse('view_planet', args=rng.choice(dataset['planets'])), {}
+
+
+def comment(rng: random.Random, dataset: Dict) -> Request:
+    return 'POST', reverse('view_planet', args=rng.choice(dataset['planets'])), {
+        'comment': f'Benchmark comment {rng.randint(0, 1000)}', 'rating': rng.randint(1, 5)}
+
+
+def upload(rng: random.Random, dataset: Dict) -> Request:
+    # Like the editor after painting a few strokes: upload the tiles that changed
+    tiles_per_side = Planet.TEXTURE_SIZE // Planet.TEXTURE_TILE_SIZE
+    tiles = {f'tile_{rng.randrange(tiles_per_side)}_{rng.randrange(tiles_per_side)}':
+             io.BytesIO(rng.choice(dataset['tiles'])) for _ in range(rng.randint(1, 4))}
+    return 'POST', reverse('edit_planet', args=rng.choice(dataset['own_planets'])), tiles
+
+
+SCENARIOS: Dict[str, Callable[[random.Random, Dict], Request]] = {
+    'home': home,
+    'leaderboard': leaderboard,
+    'search': search,
+    'view_planet': view_planet,
+    'comment': comment,
+    'upload': upload,
+}
+
+
+def load_dataset(rng: random.Random) -> Dict:
+    '''Samples the planets, users and words that the scenarios pick from.'''
+    planets = list(Planet.objects.filter(visibility=True, solarSystem__visibility=True)
+                   .values_list('solarSystem__user__username', 'solarSystem__name', 'name')[:1000])
+    words = [name for _, _, name in planets] + \
+        list(PlanetUser.objects.values_list('username', flat=True)[:1000])
+    if not planets:
+        raise ValueError('No public planets to benchmark with')
+
+    # The user making the POST requests: the one owning the most planets in his own systems
+    own_planets = Planet.objects.filter(solarSystem__user_id=F('user_id'))
+    user_id = own_planets.values('user_id').annotate(count=Count('id')) \
+        .order_by('-count').values_list('user_id', flat=True).first()
+    tiles = []
+    for _ in range(8):
+        tile = io.BytesIO()
+        color = tuple(rng.randrange(256) for _ in range(3))
+        Image.new('RGB', (Planet.TEXTURE_TILE_SIZE,) * 2, color).save(tile, 'JPEG', quality=90)
+        tiles.append(tile.getvalue())
+    return {
+        'planets': planets,
+        'words': words,
+        'user': PlanetUser.objects.get(id=user_id) if user_id else None,
+        'own_planets': list(own_planets.filter(user_id=user_id)
+                            .values_list('solarSystem__user__username', 'solarSystem__name', 'name')),
+        'tiles': tiles,
+    }
+
+
+# ======================== Measurements ========================================
+
+
+def percentile(values: List[float], p: float) -> float:
+    '''The `p`th percentile of the (sorted) `values` (nearest rank).'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def run_scenario(scenario: Callable, dataset: Dict, requests: int, concurrency: int, seed: int) -> Dict:
+    '''Makes `requests` requests from `scenario` with `concurrency` threads
+    (each with its own client); returns the throughput, latency percentiles and
+    query counts.'''
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(index: int):
+        rng = random.Random(seed * 1000 + index)
+        anonymous, logged_in = Client(), Client()
+        if dataset['user'] is not None:
+            logged_in.force_login(dataset['user'])
+        count = [0]
+
+        def count_query(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        try:
+            for _ in range(requests // concurrency + (index < requests % concurrency)):
+                method, url, data = scenario(rng, dataset)
+                count[0] = 0
+                start = time.perf_counter()
+                try:
+                    with connection.execute_wrapper(count_query):
+                        if method == 'GET':
+                            response = anonymous.get(url)
+                        else:
+                            response = logged_in.post(url, data)
+                    error = f'{response.status_code}' if response.status_code >= 400 else None
+                except Exception as e:
+                    # (The test client re-raises the exceptions of the views, as 500s)
+                    error = f'500 {repr(e)}'
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    queries.append(count[0])
+                    if error:
+                        errors.append(f'{method} {url}: {error}')
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        worker(0)  # (In this thread, so that it sees this thread's transaction)
+    else:
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall_time = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'first_errors': errors[:5],
+        'throughput_rps': round(len(latencies) / wall_time, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / max(len(latencies), 1) * 1000, 2),
+            **{f'p{p}': round(percentile(latencies, p) * 1000, 2) for p in (50, 90, 95, 99)},
+            'max': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        'queries': {
+            'mean': round(sum(queries) / max(len(queries), 1), 2),
+            'max': max(queries, default=0),
+        },
+    }
+
+
+def git_commit() -> str:
+    '''The current git commit of the code being benchmarked, if known.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(scenarios: List[str], requests: int, concurrency: int, seed: int) -> Dict:
+    '''Runs the given scenarios one after the other on the current database;
+    returns the report.'''
+    rng = random.Random(seed)
+    dataset = load_dataset(rng)
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'cpus': os.cpu_count(),
+        },
+        'dataset': {
+            'users': PlanetUser.objects.count(),
+            'systems': SolarSystem.objects.count(),
+            'planets': Planet.objects.count(),
+            'comments': Comment.objects.count(),
+        },
+        'parameters': {'requests': requests, 'concurrency': concurrency, 'seed': seed},
+        'scenarios': {},
+    }
+    with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+        for i, name in enumerate(scenarios):
+            report['scenarios'][name] = run_scenario(SCENARIOS[name], dataset, requests, concurrency, seed + i)
+    return report
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the main views and the texture upload path: seeds a scratch database '
+            'with the bulk populator, drives it with concurrent local clients and reports the '
+            'throughput, latency percentiles and query counts of each scenario as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Users to seed the scratch database with')
+        parser.add_argument('--textures', type=int, default=8, help='Distinct textures to seed it with')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed (of the dataset and the requests)')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients')
+        parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                            help='Scenarios to run (default: all)')
+        parser.add_argument('--no-view-cache', action='store_true',
+                            help='Disable the view cache (to measure the views themselves)')
+        parser.add_argument('--in-place', action='store_true',
+                            help='Benchmark the current database as is, instead of a seeded scratch database '
+                                 '(NOTE: this posts comments and uploads textures to it!)')
+        parser.add_argument('--output', help='File to write the JSON report to (default: stdout)')
+
+    def handle(self, *args, **options):
+        def run():
+            # (Keep stdout for the report)
+            with contextlib.redirect_stdout(sys.stderr):
+                report = run_benchmark(options['scenarios'], options['requests'],
+                                       max(options['concurrency'], 1), options['seed'])
+                jobs.shutdown_executor()  # (Wait for the uploaded textures to be processed)
+            return report
+
+        with contextlib.ExitStack() as stack:
+            if options['no_view_cache']:
+                stack.enter_context(override_settings(
+                    CACHES={**settings.CACHES, 'benchmark-none': {
+                        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+                    VIEW_CACHE='benchmark-none'))
+            if options['in_place']:
+                report = run()
+            else:
+                report = self.run_scratch(options, run)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_scratch(self, options: Dict, run: Callable[[], Dict]) -> Dict:
+        '''Runs `run()` on a scratch database (and media directory) seeded with
+        the bulk populator; both are deleted afterwards.'''
+        from populate_planet import populate_bulk
+        scratch_dir = tempfile.mkdtemp(prefix='wdp-benchmark-')
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        old_test_name = test_settings.get('NAME')
+        if connection.vendor == 'sqlite':
+            # (A file rather than an in-memory database, to be shared by the clients' threads)
+            test_settings['NAME'] = os.path.join(scratch_dir, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(scratch_dir, 'media')):
+                self.stderr.write(f'Seeding {options["users"]} users...')
+                with contextlib.redirect_stdout(sys.stderr):
+                    populate_bulk(options['users'], seed=options['seed'], texture_count=options['textures'])
+                self.stderr.write('Running the benchmark...')
+                return run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = old_test_name
+            shutil.rmtree(scratch_dir, ignore_errors=True)
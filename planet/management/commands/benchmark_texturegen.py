@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from planet import texturegen, textures
+from planet.models import Planet
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the procedural texture generator (see planet/texturegen.py); '
+            'reports the CPU time of each step, and of the texture of new planets '
+            '(as in `views.create_planet`, then its texture job).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=2048, help='Texture size (in pixels)')
+        parser.add_argument('--detail', type=int, default=512, help='Noise resolution (in pixels)')
+        parser.add_argument('--runs', type=int, default=10, help='Number of textures to generate')
+
+    def measure(self, label: str, func, runs: int):
+        '''Runs `func(seed)` `runs` times; prints and returns the mean CPU time (in ms).'''
+        times = []
+        for seed in range(runs):
+            start = time.process_time()
+            func(seed)
+            times.append((time.process_time() - start) * 1000)
+        self.stdout.write(f'{label:<32} mean {sum(times) / runs:8.1f} ms    min {min(times):8.1f} ms')
+        return sum(times) / runs
+
+    def handle(self, *args, **options):
+        size, detail, runs = options['size'], options['detail'], options['runs']
+        self.stdout.write(f'{runs} runs, {size}x{size} pixels, noise at {min(size, detail)}x{min(size, detail)}')
+
+        def plain(seed):
+            # What new planets used to get: a plain color, JPEG-encoded
+            Image.new('RGB', (size, size), (seed, seed, seed)).save(io.BytesIO(), 'JPEG')
+
+        self.measure('Plain color + JPEG (old)', plain, runs)
+        self.measure('fBm noise', lambda seed: texturegen.fbm(
+            np.random.RandomState(seed), min(size, detail)), runs)
+        self.measure('Texture', lambda seed: texturegen.generate_texture(
+            size, seed, detail=detail), runs)
+        self.measure('Texture + JPEG', lambda seed: texturegen.generate_texture_jpeg(
+            size, seed, detail=detail), runs)
+
+        # The exact path of new planets: the texture generated by the request (at
+        # `Planet.TEXTURE_SIZE`, whatever --size), then its texture job (which also
+        # generates the thumbnails and tile pyramid)
+        scratch_dir = tempfile.mkdtemp(prefix='wdp-texturegen-')
+        try:
+            with override_settings(MEDIA_ROOT=scratch_dir):
+                os.makedirs(os.path.join(scratch_dir, 'planets'))
+
+                def create_planet(seed, half_size=False):
+                    if half_size:
+                        data = texturegen.generate_texture_jpeg(Planet.TEXTURE_SIZE // 2, seed)
+                    else:
+                        data = texturegen.generate_planet_texture_jpeg(Planet.TEXTURE_SIZE, seed)
+                    with open(os.path.join(scratch_dir, 'planets', f'{seed}.jpg'), 'wb') as f:
+                        f.write(data)
+
+                def texture_job(seed):
+                    textures.process_texture(f'planets/{seed}.jpg', Planet.TEXTURE_SIZE)
+
+                self.measure('create_planet texture', create_planet, runs)
+                self.measure('create_planet texture job', texture_job, runs)
+                # What new planets used to get: half size, upscaled and re-encoded by the job
+                self.measure('create_planet half size (old)', lambda seed: create_planet(seed, half_size=True), runs)
+                self.measure('create_planet texture job (old)', texture_job, runs)
+        finally:
+            shutil.rmtree(scratch_dir)
@@ -0,0 +1,45 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from planet import textures
+from planet.storage import texture_storage
+
+
+class Command(BaseCommand):
+    help = ('Deletes the planet textures that no planet uses anymore, and the '
+            'thumbnails and tile pyramids of textures that do not exist anymore.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only list what would be deleted')
+
+    def list_files(self, directory: str):
+        '''Yields the names (relative to MEDIA_ROOT) of all files in `directory`.'''
+        for dirpath, _, filenames in os.walk(os.path.join(settings.MEDIA_ROOT, directory)):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), settings.MEDIA_ROOT)
+
+    def handle(self, *args, **options):
+        texture_names = list(self.list_files('planets'))
+        garbage = texture_storage.collectable(texture_names)
+        for name in garbage:
+            self.stdout.write(f'Unused texture: {name}')
+            if not options['dry_run']:
+                texture_storage.delete(name)
+
+        # Derivatives whose texture is gone (ex. deleted while the derivatives were being generated)
+        remaining = {os.path.splitext(name)[0] for name in set(texture_names) - set(garbage)}
+        orphans = []
+        for size in textures.THUMBNAIL_SIZES:
+            thumbs_dir = os.path.join(textures.THUMBNAIL_DIR, str(size))
+            orphans += [name for name in self.list_files(thumbs_dir)
+                        if os.path.splitext(os.path.relpath(name, thumbs_dir))[0] not in remaining]
+        orphans += [name for name in self.list_files(textures.PYRAMID_DIR)
+                    if os.path.splitext(os.path.relpath(name, textures.PYRAMID_DIR))[0] not in remaining]
+        for name in orphans:
+            self.stdout.write(f'Orphaned derivative: {name}')
+            if not options['dry_run']:
+                os.remove(os.path.join(settings.MEDIA_ROOT, name))
+
+        self.stdout.write(f'{"Found" if options["dry_run"] else "Deleted"} '
+                          f'{len(garbage)} unused texture(s) and {len(orphans)} orphaned derivative(s)')
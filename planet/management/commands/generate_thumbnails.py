@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from planet.models import Planet
+from planet import textures
+
+
+class Command(BaseCommand):
+    help = 'Generates missing or outdated thumbnails and tile pyramids for all planet textures.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate all thumbnails, even if up-to-date')
+
+    def handle(self, *args, **options):
+        count = 0
+        for planet in Planet.objects.only('id', 'texture').iterator():
+            if options['force'] or planet.thumbnails_outdated():
+                textures.generate_thumbnails(planet.texture.name)
+                textures.generate_pyramid(planet.texture.name)
+                count += 1
+        self.stdout.write(f'Generated thumbnails for {count} planet(s)')
@@ -0,0 +1,34 @@
+import os
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from planet.models import PlanetUser
+from planet import avatars
+
+
+class Command(BaseCommand):
+    help = ('Normalizes the avatars uploaded before avatars were processed, and generates '
+            'missing variants for the others (see planet/avatars.py).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate all variants, even if present')
+
+    def handle(self, *args, **options):
+        normalized, generated = 0, 0
+        for user in PlanetUser.objects.exclude(avatar='').exclude(avatar=None).iterator():
+            name = user.avatar.name
+            if not avatars.is_normalized(name):
+                try:
+                    with user.avatar.open('rb') as f:
+                        user.avatar = ContentFile(f.read(), name=os.path.basename(name))
+                    # (Normalized by `PlanetUser.save()`; django-cleanup deletes the original)
+                    user.save()
+                except OSError as e:
+                    self.stderr.write(f'{user.username}: cannot process avatar {name}: {repr(e)}')
+                    continue
+                normalized += 1
+            elif options['force'] or not all(os.path.exists(avatars.variant_path(name, size))
+                                             for size in avatars.AVATAR_VARIANT_SIZES):
+                avatars.generate_variants(name)
+                generated += 1
+        self.stdout.write(f'Normalized {normalized} avatar(s), generated variants for {generated} more')
@@ -0,0 +1,30 @@
+from concurrent.futures import wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from planet.models import TextureJob
+from planet import jobs
+
+
+class Command(BaseCommand):
+    help = ('Runs all texture jobs that have not completed yet, for example '
+            'after a server restart or crash.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry jobs that have failed')
+
+    def handle(self, *args, **options):
+        states = [TextureJob.PENDING, TextureJob.RUNNING]
+        if options['retry_failed']:
+            states.append(TextureJob.FAILED)
+
+        queued = list(TextureJob.objects.filter(state__in=states).order_by('created'))
+        if settings.TEXTURE_WORKERS:
+            wait([jobs.submit_job(job) for job in queued])
+        else:
+            for job in queued:
+                jobs.run_job(job)
+
+        failed = TextureJob.objects.filter(
+            id__in=[job.id for job in queued], state=TextureJob.FAILED).count()
+        self.stdout.write(f'Processed {len(queued)} job(s), {failed} failed')
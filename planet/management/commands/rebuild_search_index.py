@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from planet import webhose_search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index for planets, solar systems and users.'
+
+    def handle(self, *args, **options):
+        if not webhose_search.index_available():
+            self.stdout.write('The search index is not supported on this database')
+            return
+        webhose_search.create_index()
+        self.stdout.write('Search index rebuilt')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from planet import scores
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the scores of all planets and solar systems from the '
+            'ratings of their comments.')
+
+    def handle(self, *args, **options):
+        scores.recompute_scores()
+        self.stdout.write('Scores recomputed')
@@ -0,0 +1,252 @@
+import bisect
+import contextlib
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+from django.template.backends.django import DjangoTemplates
+
+
+# ======================== Metrics =============================================
+# Per-view request latency, SQL query counts/time, template render time and
+# image processing time, kept in-process as Prometheus-style histograms and
+# counters (so each server process has its own) and exported as text by
+# `views.metrics`. See `MetricsMiddleware`, `InstrumentedTemplates` and `timed()`.
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+METRICS = {
+    # name: (type, description, histogram buckets)
+    'wdp_requests_total': ('counter', 'Requests handled, by view, method and status', None),
+    'wdp_request_duration_seconds': ('histogram', 'Request latency, by view', SECONDS_BUCKETS),
+    'wdp_request_queries': ('histogram', 'SQL queries per request, by view', COUNT_BUCKETS),
+    'wdp_request_query_seconds': ('histogram', 'Time spent in SQL queries per request, by view', SECONDS_BUCKETS),
+    'wdp_request_template_seconds': ('histogram', 'Time spent rendering templates per request, by view', SECONDS_BUCKETS),
+    'wdp_request_image_seconds': ('histogram', 'Time spent processing images per request, by view', SECONDS_BUCKETS),
+    'wdp_template_render_seconds': ('histogram', 'Template render time, by template', SECONDS_BUCKETS),
+    'wdp_image_processing_seconds': ('histogram', 'Image processing time, by operation', SECONDS_BUCKETS),
+    'wdp_request_profiles_total': ('counter', 'Profiles of slow requests dumped, by view', None),
+}
+'''All metrics; their names and labels follow the Prometheus conventions.'''
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    '''A cumulative histogram of observed values, as in Prometheus.'''
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # (The last one is +Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Labels], Histogram] = {}
+_counters: Dict[Tuple[str, Labels], float] = {}
+
+
+def observe(name: str, value: float, **labels: str):
+    '''Adds `value` to the histogram `name` with the given labels.'''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(METRICS[name][2])
+        histogram.observe(value)
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    '''Adds `value` to the counter `name` with the given labels.'''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def reset():
+    '''Forgets all observations.'''
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def render() -> str:
+    '''Returns all metrics in the Prometheus text exposition format.'''
+    with _lock:
+        histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    for name, (kind, description, _) in METRICS.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        if kind == 'counter':
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+            continue
+        for (key_name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+# ======================== Instrumentation =====================================
+
+_current = threading.local()
+'''The totals of the request being handled by this thread (see `MetricsMiddleware`).'''
+
+
+def _add_to_request(total: str, value: float):
+    totals = getattr(_current, 'totals', None)
+    if totals is not None:
+        totals[total] += value
+
+
+class timed(contextlib.ContextDecorator):
+    '''Context manager/decorator that records the time spent in an image
+    processing `operation` (ex. `@timed('generate_thumbnails')`).
+    Nested operations only count once towards the request's image time.'''
+
+    def __init__(self, operation: str):
+        self.operation = operation
+
+    def _recreate_cm(self):
+        return timed(self.operation)  # (A decorated function may run in many threads at once)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        _current.image_depth = getattr(_current, 'image_depth', 0) + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        _current.image_depth -= 1
+        observe('wdp_image_processing_seconds', elapsed, operation=self.operation)
+        if _current.image_depth == 0:
+            _add_to_request('image', elapsed)
+        return False
+
+
+class InstrumentedTemplates(DjangoTemplates):
+    '''The Django template backend, recording the render time of templates.'''
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code), '<string>')
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name), template_name)
+
+
+class InstrumentedTemplate:
+    def __init__(self, template, name: str):
+        self.template = template
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.template, attr)
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe('wdp_template_render_seconds', elapsed, template=self.name)
+            _add_to_request('template', elapsed)
+
+
+class MetricsMiddleware:
+    '''Records the latency, SQL queries and template/image processing time of
+    each request, by view; and, for a sample of the requests
+    (`settings.METRICS_PROFILE_RATE`), profiles them with cProfile, keeping the
+    profiles of those slower than `settings.METRICS_PROFILE_SLOW` seconds in
+    `settings.METRICS_PROFILE_DIR` (to be read with `pstats` or snakeviz).'''
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        _current.totals = totals = {'queries': 0, 'query': 0.0, 'template': 0.0, 'image': 0.0}
+        profiler = None
+        if settings.METRICS_PROFILE_RATE and random.random() < settings.METRICS_PROFILE_RATE:
+            profiler = cProfile.Profile()
+
+        def record_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                totals['queries'] += 1
+                totals['query'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                if profiler is not None:
+                    profiler.enable()
+                    stack.callback(profiler.disable)
+                response = self.get_response(request)
+        finally:
+            _current.totals = None
+        elapsed = time.perf_counter() - start
+
+        # (Unresolved URLs are lumped together, to bound the number of label values)
+        view = request.resolver_match.view_name if request.resolver_match else '<unresolved>'
+        inc('wdp_requests_total', view=view, method=request.method, status=str(response.status_code))
+        observe('wdp_request_duration_seconds', elapsed, view=view)
+        observe('wdp_request_queries', totals['queries'], view=view)
+        observe('wdp_request_query_seconds', totals['query'], view=view)
+        observe('wdp_request_template_seconds', totals['template'], view=view)
+        observe('wdp_request_image_seconds', totals['image'], view=view)
+        if profiler is not None and elapsed >= settings.METRICS_PROFILE_SLOW:
+            self.dump_profile(profiler, view, elapsed)
+        return response
+
+    def dump_profile(self, profiler: cProfile.Profile, view: str, elapsed: float) -> Optional[str]:
+        '''Saves the profile of a slow request; returns its path.'''
+        os.makedirs(settings.METRICS_PROFILE_DIR, exist_ok=True)
+        filename = f'{view.replace(":", "-")}-{time.strftime("%Y%m%d-%H%M%S")}-{int(elapsed * 1000)}ms.prof'
+        path = os.path.join(settings.METRICS_PROFILE_DIR, filename)
+        try:
+            profiler.dump_stats(path)
+        except OSError as e:
+            logger.error(f'Could not save the profile of a slow request to {path}: {repr(e)}')
+            return None
+        inc('wdp_request_profiles_total', view=view)
+        logger.info(f'{view}: took {elapsed:.3f}s, profile saved to {path}')
+        return path
@@ -1,15 +1,21 @@
 import logging
 import os
-import PIL
-from django.db import models
+from typing import List, Optional, Tuple
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.contrib.auth.validators import ASCIIUsernameValidator
 from WadThePlanet import settings
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator
 import re
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.files.base import ContentFile
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
+from django_cleanup.signals import cleanup_pre_delete
+from planet import avatars, textures
+from planet.storage import texture_storage
 
 
 # ======================== Utilities ===========================================
@@ -33,7 +39,7 @@ def name_validator(name: str):
 def content_file_name(instance, filename):
     ext = filename.split('.')[-1]
     filename = f'{instance.username}.{ext}'
-    return os.path.join('profile_images/', filename)
+    return os.path.join(avatars.AVATAR_DIR, filename)
 
 # ======================== Models ==============================================
 
@@ -44,19 +50,52 @@ class PlanetUser(AbstractUser):
         max_length=255)
     avatar = models.ImageField(
         upload_to=content_file_name, blank=True, null=True)
+    # Incremented (and `modified` updated) whenever the user's page may change; the
+    # page's ETag and Last-Modified are derived from them (see planet/revisions.py)
+    revision = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
 
     REQUIRED_FIELDS = ['email']
     username_validator = name_validator
 
+    # The username and searchable fields stored in the DB (see `remember_saved_state()`)
+    _page_name = None
+    _search_state = None
+
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        remember_saved_state(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Overridden save() method that normalizes newly-uploaded avatars and
+        # generates their smaller variants (see planet/avatars.py)
+        avatar_uploaded = bool(self.avatar) and not self.avatar._committed
+        if avatar_uploaded:
+            self.avatar = ContentFile(avatars.normalize_avatar(self.avatar), name=f'{self.username}.jpg')
+        super().save(*args, **kwargs)
+        if avatar_uploaded:
+            avatars.generate_variants(self.avatar.name)
+
     @property
     def avatar_path(self):
         if self.avatar and hasattr(self.avatar, 'url'):
-            logger.warning(self.avatar.url)
             return self.avatar.url
 
+    @property
+    def avatar_thumbnail_url(self) -> str:
+        '''The URL of the small variant of the avatar, for pages showing many
+        avatars at once; that of the original file if it was not normalized.'''
+        if not self.avatar:
+            return ''
+        if avatars.is_normalized(self.avatar.name):
+            return settings.MEDIA_URL + avatars.variant_name(self.avatar.name, min(avatars.AVATAR_VARIANT_SIZES))
+        return self.avatar.url
+
 
 class SolarSystem(models.Model):
 
@@ -73,10 +112,30 @@ class SolarSystem(models.Model):
     visibility = models.BooleanField(blank=False, default=True)
     # Score of the SolarSystem
     score = models.IntegerField(default=0)
+    # Incremented (and `modified` updated) whenever the solar system's page may change; the
+    # page's ETag and Last-Modified are derived from them (see planet/revisions.py)
+    revision = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    # The name and searchable fields stored in the DB (see `remember_saved_state()`)
+    _page_name = None
+    _search_state = None
 
     class Meta:
         # Disallow multiple solar systems with the same name from the same user
+        # (the unique index also resolves the systems' URLs; see planet/resolvers.py)
         unique_together = ('user', 'name')
+        # Indices for the leaderboard's keyset pagination (see planet/leaderboard.py)
+        indexes = [
+            models.Index(fields=['visibility', '-score', '-id']),
+            models.Index(fields=['visibility', 'name', 'id']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        remember_saved_state(instance)
+        return instance
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -88,6 +147,9 @@ class SolarSystem(models.Model):
 class Planet(models.Model):
     # The size of the textures to save (in pixels, should be power-of-two)
     TEXTURE_SIZE = 2048
+    # The size of the tiles the editor uploads when only part of a texture changed
+    # (in pixels, should be power-of-two; see editor.js)
+    TEXTURE_TILE_SIZE = 256
 
     # An unique numeric id for each planet
     id = models.AutoField(null=False, primary_key=True)
@@ -98,34 +160,140 @@ class Planet(models.Model):
     user = models.ForeignKey(PlanetUser, on_delete=models.CASCADE)
     # foreign key to the solarsystem it belongs to
     solarSystem = models.ForeignKey(SolarSystem, on_delete=models.CASCADE)
-    # The planet's texture (as painted by the user).
-    texture = models.ImageField(null=False, upload_to='planets')
+    # The planet's texture (as painted by the user). Stored by content hash, and
+    # possibly shared with other planets (see planet/storage.py)
+    texture = models.ImageField(null=False, upload_to='planets', storage=texture_storage, db_index=True)
     # Privacy setting of planet. Visibility True - visible to all users
     visibility = models.BooleanField(blank=False, default=True)
     # Score of the planet
     score = models.IntegerField(default=0)
+    # Number of comments on the planet, and of ratings of each number of stars;
+    # maintained on comment write (see `scores.record_comment()`), so that pages
+    # can show the average rating without aggregating the comments
+    comment_count = models.IntegerField(default=0)
+    ratings_1 = models.IntegerField(default=0)
+    ratings_2 = models.IntegerField(default=0)
+    ratings_3 = models.IntegerField(default=0)
+    ratings_4 = models.IntegerField(default=0)
+    ratings_5 = models.IntegerField(default=0)
+    # True while a `TextureJob` is resizing the texture/generating its thumbnails
+    processing = models.BooleanField(default=False)
+    # Incremented (and `modified` updated) whenever the planet's page may change; the
+    # page's ETag and Last-Modified are derived from them (see planet/revisions.py)
+    revision = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    # The fields summarizing the planet's comments; only ever written by atomic
+    # UPDATEs (see `scores.record_comment()`), as an instance's copy may be stale
+    SUMMARY_FIELDS = ('score', 'comment_count', 'ratings_1', 'ratings_2', 'ratings_3', 'ratings_4', 'ratings_5')
+
+    # The texture name stored in the DB for this planet (see `from_db()`)
+    _saved_texture = None
+    # The name and searchable fields stored in the DB (see `remember_saved_state()`)
+    _page_name = None
+    _search_state = None
 
     class Meta:
         # Disallow multiple planets with the same name in the same solar system
+        # (the unique index also resolves the planets' URLs; see planet/resolvers.py)
         unique_together = ('solarSystem', 'name')
+        # Indices for the leaderboard's keyset pagination (see planet/leaderboard.py)
+        indexes = [
+            models.Index(fields=['visibility', '-score', '-id']),
+            models.Index(fields=['visibility', 'name', 'id']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the texture as stored in the DB, so that save() can tell if it changed
+        # (By name: the field may already hold a FieldFile, which texture.save() would update in place)
+        texture = instance.__dict__.get('texture')
+        instance._saved_texture = getattr(texture, 'name', texture)
+        remember_saved_state(instance)
+        return instance
 
     def save(self, *args, **kwargs):
-        # Overridden save() method that resizes the uploaded `texture` if required
+        # Overridden save() method that queues a job to resize the uploaded
+        # `texture` if required and to generate its thumbnails
+        # (Updates do not write back the comment summary, see `SUMMARY_FIELDS`)
+        if not self._state.adding and not args and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.SUMMARY_FIELDS]
+        texture_changed = self.texture.name != self._saved_texture
+        if texture_changed:
+            self.processing = True
         super().save(*args, **kwargs)
-        with PIL.Image.open(self.texture.path) as pil_img:
-            width, height = pil_img.size
-            if width != self.TEXTURE_SIZE or height != self.TEXTURE_SIZE:
-                # Rescale image to correct size and save
-                logger.debug(f'Planet{self.id}: Image has wrong size {width}x{height},'
-                             f'resizing it to {self.TEXTURE_SIZE}x{self.TEXTURE_SIZE}')
-                pil_img.resize(
-                    (self.TEXTURE_SIZE, self.TEXTURE_SIZE), resample=PIL.Image.BICUBIC)
-                pil_img.save(self.texture.path, quality=90, optimize=True)
+        if texture_changed:
+            self._saved_texture = self.texture.name
+            from planet import jobs
+            jobs.enqueue_texture_job(self)
+
+    def thumbnails_outdated(self) -> bool:
+        '''Returns True if any of the texture's thumbnails (or its tile pyramid)
+        is missing or older than the texture itself.'''
+        texture_mtime = os.path.getmtime(self.texture.path)
+        paths = [textures.thumbnail_path(self.texture.name, size) for size in textures.THUMBNAIL_SIZES]
+        paths.append(textures.pyramid_path(self.texture.name))
+        for path in paths:
+            if not os.path.exists(path) or os.path.getmtime(path) < texture_mtime:
+                return True
+        return False
+
+    @property
+    def rating_count(self) -> int:
+        '''The number of comments with a rating.'''
+        return sum(getattr(self, f'ratings_{stars}') for stars in range(1, 6))
+
+    @property
+    def average_rating(self) -> Optional[float]:
+        '''The average rating (in stars) of the planet, or None if it has none.'''
+        count = self.rating_count
+        if not count:
+            return None
+        return sum(stars * getattr(self, f'ratings_{stars}') for stars in range(1, 6)) / count
+
+    @property
+    def rating_histogram(self) -> List[Tuple[int, int, int]]:
+        '''The `(stars, count, percentage)` of each rating, from 5 stars down to 1.'''
+        total = max(self.rating_count, 1)
+        return [(stars, getattr(self, f'ratings_{stars}'), round(100 * getattr(self, f'ratings_{stars}') / total))
+                for stars in range(5, 0, -1)]
+
+    def has_tile_pyramid(self) -> bool:
+        '''Returns True if the texture's tile pyramid is available.'''
+        return not self.processing and os.path.exists(textures.pyramid_path(self.texture.name))
+
+    @property
+    def texture_url(self) -> str:
+        '''The URL of the texture. Textures are stored by content hash, so their
+        URLs are immutable once processed (see `views.serve_media()`); while
+        processing, the file may still be resized in place.'''
+        if self.processing:
+            return self.texture.url + '?processing'
+        return self.texture.url
+
+    @property
+    def pyramid_url(self) -> str:
+        '''The URL of the texture's tile pyramid (see `has_tile_pyramid()`); editor.js
+        reads its levels with HTTP Range requests. Its name only depends on the
+        texture's, so it is immutable too (see `views.serve_media()`).'''
+        return settings.MEDIA_URL + textures.pyramid_name(self.texture.name)
+
+    def thumbnail_url(self, size: int) -> str:
+        '''Returns the URL of the smallest thumbnail of the texture that is at
+        least `size` pixels wide (or of the texture itself while processing).'''
+        if self.processing:
+            return self.texture_url
+        size = textures.nearest_thumbnail_size(size)
+        return settings.MEDIA_URL + textures.thumbnail_name(self.texture.name, size)
 
     def delete(self, *args, **kwargs):
-        self.solarSystem.score -= self.score
-        self.solarSystem.save()
-        super().delete(*args, **kwargs)
+        from planet import scores
+        with transaction.atomic():
+            scores.subtract_planet_score(self.id)
+            return super().delete(*args, **kwargs)
 
     def __str__(self) -> str:
         return self.name
@@ -144,36 +312,294 @@ class Comment(models.Model):
     class Meta:
         # Disallow multiple comments on a planet from the same user
         unique_together = ('planet', 'user')
+        # Index for the keyset pagination of a planet's comments, newest first (see `views.view_planet`)
+        indexes = [
+            models.Index(fields=['planet', '-id']),
+        ]
 
     def save(self, *args, **kwargs):
         '''
-        Save the comment, recalculating the score of the parent planet and solar
-        system as needed.
+        Save the comment, atomically updating the score of the parent planet and
+        solar system as needed.
         '''
-        try:
-            # Get the comment with our same primary key; it will be the previous
-            # version of this comment, containing the previous rating
-            prev_comment = Comment.objects.get(pk=self.pk)
-            prev_rating = prev_comment.rating
-        except Comment.DoesNotExist:
-            # There was no previous comment; assume a previous value of 0 = no rating
-            prev_rating = 0
-
-        #Add comment score to planet score
-        self.planet.score += self.rating - prev_rating
-        self.planet.save()
-
-        #Add comment score to solar system score
-        self.planet.solarSystem.score += self.rating - prev_rating
-        self.planet.solarSystem.save()
-
-        # Apply the changes to the DB row
-        super().save(*args, **kwargs)
+        from planet import scores
+        with transaction.atomic():
+            prev_rating = None
+            if self.pk is not None:
+                # Get (and lock) the previous version of this comment, containing the previous rating
+                # (None if there was no previous comment)
+                prev_rating = Comment.objects.select_for_update().filter(pk=self.pk) \
+                    .values_list('rating', flat=True).first()
+
+            # Apply the changes to the DB row
+            super().save(*args, **kwargs)
+            # Update the planet's comment summary, and the planet and solar system scores
+            scores.record_comment(self.planet_id, prev_rating, self.rating)
         return self
 
     def delete(self, *args, **kwargs):
-        self.planet.score -= self.score
-        self.planet.save()
-        self.planet.solarSystem.score -= self.score
-        self.planet.solarSystem.save()
-        super().delete(*args, **kwargs)
+        from planet import scores
+        with transaction.atomic():
+            rating = Comment.objects.select_for_update().filter(pk=self.pk) \
+                .values_list('rating', flat=True).first()
+            if rating is not None:
+                scores.record_comment(self.planet_id, rating, None)
+            return super().delete(*args, **kwargs)
+
+
+class TextureJob(models.Model):
+    '''A (durable) job to process a planet's texture in the background;
+    see `planet.jobs`.'''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = [(PENDING, 'Pending'), (RUNNING, 'Running'),
+              (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # The planet whose texture is to be processed
+    planet = models.ForeignKey(Planet, on_delete=models.CASCADE)
+    # The name of the texture to process (the planet's texture may change meanwhile)
+    texture = models.CharField(max_length=255)
+    # The state of the job
+    state = models.CharField(max_length=10, choices=STATES, default=PENDING)
+    # Error message (if the job failed)
+    error = models.TextField(blank=True, default='')
+    # When the job was queued and last updated
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['state', 'created'])]
+
+    def __str__(self) -> str:
+        return f'{self.texture} ({self.state})'
+
+
+class Ranking(models.Model):
+    '''An entry of the (optional) materialized leaderboard ranking; holds the
+    score of a visible planet or solar system. See planet/leaderboard.py.'''
+    PLANET = 'planet'
+    SYSTEM = 'system'
+    KINDS = [(PLANET, 'Planet'), (SYSTEM, 'Solar system')]
+
+    # The kind of the ranked object
+    kind = models.CharField(max_length=6, choices=KINDS)
+    # The id of the ranked planet/solar system
+    object_id = models.IntegerField()
+    # The score of the ranked object
+    score = models.IntegerField()
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+        indexes = [models.Index(fields=['kind', '-score', '-object_id'])]
+
+    @classmethod
+    def kind_of(cls, model: 'Model') -> str:
+        '''Returns the kind of ranking entries for the given model.'''
+        return cls.PLANET if model is Planet else cls.SYSTEM
+
+    def __str__(self) -> str:
+        return f'{self.kind}{self.object_id}: {self.score}'
+
+
+# ======================== Signal handlers =====================================
+
+
+@receiver(pre_save, sender=Planet)
+@receiver(pre_save, sender=SolarSystem)
+@receiver(pre_save, sender=PlanetUser)
+def bump_revision(sender, instance, raw, update_fields, **kwargs):
+    '''Bumps the revision of saved planets/systems/users (see planet/revisions.py),
+    unless only other fields are saved (ex. `last_login`, on login).'''
+    if raw or (update_fields is not None and 'revision' not in update_fields):
+        return
+    instance.revision += 1
+    instance.modified = timezone.now()
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+def refresh_ranking_on_save(sender, instance, raw, **kwargs):
+    '''Keeps the leaderboard ranking table in sync with saved planets/systems.'''
+    if raw:
+        return
+    from planet import leaderboard
+    leaderboard.refresh_rankings(sender, [instance.id])
+
+
+@receiver(post_delete, sender=Planet)
+@receiver(post_delete, sender=SolarSystem)
+def delete_ranking(sender, instance, **kwargs):
+    '''Removes deleted planets/systems from the leaderboard ranking table.'''
+    from planet import leaderboard
+    leaderboard.remove_rankings(sender, [instance.id])
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+@receiver(post_save, sender=PlanetUser)
+def update_search_index(sender, instance, raw, created, using, **kwargs):
+    '''Keeps the search index (and suggestions) in sync with saved planets/systems/users.'''
+    if raw:
+        return
+    from planet import webhose_search
+    search_state = webhose_search.searchable_state(instance)
+    if not created and search_state == instance._search_state:
+        return  # Nothing changed in the search results
+    webhose_search.update_index([instance], using)
+    webhose_search.invalidate_suggestions()
+    instance._search_state = search_state
+
+
+@receiver(post_delete, sender=Planet)
+@receiver(post_delete, sender=SolarSystem)
+@receiver(post_delete, sender=PlanetUser)
+def remove_from_search_index(sender, instance, using, **kwargs):
+    '''Removes deleted planets/systems/users from the search index (and suggestions).'''
+    from planet import webhose_search
+    webhose_search.remove_from_index(instance, using)
+    webhose_search.invalidate_suggestions()
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    '''(Re)creates the search index after the planet app has been migrated.'''
+    if sender.name == 'planet':
+        from planet import webhose_search
+        webhose_search.create_index(using)
+
+
+def remember_saved_state(instance: models.Model):
+    '''Remembers the name and searchable fields of a planet/system/user as stored
+    in the DB, to tell if its pages moved or its search entry changed on save (see
+    the handlers below); on load (from `from_db()`, rather than on every
+    instantiation) and after saves. New instances keep the class defaults (None).'''
+    from planet import webhose_search
+    instance._page_name = instance.__dict__.get('username' if isinstance(instance, PlanetUser) else 'name')
+    instance._search_state = webhose_search.searchable_state(instance)
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+@receiver(post_save, sender=PlanetUser)
+def invalidate_cached_pages_on_save(sender, instance, raw, created, update_fields, **kwargs):
+    '''Invalidates the cached pages showing saved planets/systems/users.
+    (Those showing comments are invalidated by `scores.record_comment()`.)'''
+    if raw:
+        return
+    from planet import viewcache
+    if sender is PlanetUser:
+        if created or update_fields == frozenset(['last_login']):
+            return  # Not shown anywhere yet/not shown at all
+        if instance._page_name not in (None, instance.username):
+            viewcache.invalidate(viewcache.ALL)  # All pages linking to the user moved
+        else:
+            viewcache.invalidate(*viewcache.user_tags(instance))
+    elif sender is SolarSystem:
+        if instance._page_name not in (None, instance.name):
+            viewcache.invalidate(viewcache.ALL)  # All pages of its planets moved
+        else:
+            viewcache.invalidate(*viewcache.system_tags(instance))
+    else:
+        tags = viewcache.planet_tags(instance)
+        if instance._page_name not in (None, instance.name):
+            owner = instance.solarSystem.user.username
+            tags.append(viewcache.planet_tag(owner, instance.solarSystem.name, instance._page_name))
+        viewcache.invalidate(*tags)
+
+
+@receiver(post_delete, sender=Planet)
+@receiver(post_delete, sender=SolarSystem)
+@receiver(post_delete, sender=PlanetUser)
+def invalidate_cached_pages_on_delete(sender, instance, **kwargs):
+    '''Invalidates the cached pages showing deleted planets/systems/users.'''
+    from planet import viewcache
+    try:
+        if sender is SolarSystem:
+            tags = viewcache.system_tags(instance)
+        elif sender is Planet:
+            tags = viewcache.planet_tags(instance)
+        else:
+            tags = [viewcache.ALL]  # The user's pages, and anything showing his comments
+    except ObjectDoesNotExist:
+        # Deleted as part of a cascade, along with its parents
+        tags = [viewcache.ALL]
+    viewcache.invalidate(*tags)
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+@receiver(post_save, sender=PlanetUser)
+def bump_revisions_on_save(sender, instance, raw, created, update_fields, **kwargs):
+    '''Bumps the revisions of the other pages showing saved planets/systems/users.
+    (Those of the pages showing comments are bumped by `scores.record_comment()`.)'''
+    if raw:
+        return
+    from planet import revisions
+    if sender is PlanetUser:
+        if created or update_fields == frozenset(['last_login']):
+            return
+        if instance._page_name not in (None, instance.username):
+            revisions.bump_all()  # All pages linking to the user changed
+        else:
+            # (His avatar is shown on his solar systems' pages, and next to his comments)
+            revisions.bump(SolarSystem, instance.solarsystem_set.values('id'))
+            revisions.bump(Planet, Comment.objects.filter(user=instance).values('planet'))
+    elif sender is SolarSystem:
+        planets = Planet.objects.filter(solarSystem=instance)
+        revisions.bump(Planet, planets.values('id'))
+        revisions.bump(PlanetUser, PlanetUser.objects.filter(
+            models.Q(id=instance.user_id) | models.Q(id__in=planets.values('user'))).values('id'))
+    else:
+        revisions.bump_around_planets([instance.id])
+
+
+@receiver(pre_delete, sender=Planet)
+@receiver(pre_delete, sender=SolarSystem)
+def bump_revisions_on_delete(sender, instance, **kwargs):
+    '''Bumps the revisions of the other pages showing planets/systems about to be deleted.'''
+    from planet import revisions
+    if sender is SolarSystem:
+        revisions.bump(PlanetUser, [instance.user_id])
+    else:
+        revisions.bump_around_planets([instance.id])
+
+
+@receiver(cleanup_pre_delete)
+def delete_avatar_variants(sender, file, **kwargs):
+    '''Deletes the variants of the avatars django-cleanup is about to delete (when
+    replaced, or when their user is deleted).'''
+    if file.name and avatars.is_normalized(file.name):
+        avatars.delete_variants(file.name)
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+@receiver(post_save, sender=PlanetUser)
+def forget_resolved_names_on_rename(sender, instance, raw, created, **kwargs):
+    '''Forgets the ids resolved from the names of pages (see planet/resolvers.py)
+    when a planet/system/user is renamed.'''
+    name = instance.username if sender is PlanetUser else instance.name
+    if not raw and not created and instance._page_name not in (None, name):
+        from planet import resolvers
+        resolvers.invalidate()
+
+
+@receiver(post_delete, sender=Planet)
+@receiver(post_delete, sender=SolarSystem)
+@receiver(post_delete, sender=PlanetUser)
+def forget_resolved_names_on_delete(sender, instance, **kwargs):
+    '''Forgets the ids resolved from the names of pages when a planet/system/user is deleted.'''
+    from planet import resolvers
+    resolvers.invalidate()
+
+
+@receiver(post_save, sender=Planet)
+@receiver(post_save, sender=SolarSystem)
+@receiver(post_save, sender=PlanetUser)
+def remember_saved_state_on_save(sender, instance, **kwargs):
+    '''Remembers the new name (and searchable fields) of saved instances; after the
+    handlers above, which compare them with the old ones.'''
+    remember_saved_state(instance)
+
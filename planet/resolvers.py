@@ -0,0 +1,66 @@
+from typing import Dict, Hashable, Optional
+from django.db.models import Model, QuerySet
+from planet.caching import LRUCache
+from planet.models import Planet, SolarSystem, PlanetUser
+
+
+# ======================== URL resolution ======================================
+# Pages are addressed by name: /<username>/<systemname>/<planetname>/. Users are
+# looked up by their (unique) username, solar systems by their (user, name)
+# unique index and planets by their (solarSystem, name) unique index, joined
+# along those (three unique index probes); the ids they resolve to are
+# remembered in a small in-process cache, so that later lookups are single
+# primary key probes, without the joins.
+# Cached ids are trusted, only checked against the object's own name (a column
+# of the row probed): a stale entry after a rename or delete of the object
+# itself is just a cache miss. Renames and deletes in this process clear the
+# cache (see the signal handlers in planet/models.py, and planet/deletion.py);
+# the names of the parents (system, user) are not checked, so another process
+# renaming those leaves the old paths resolving here until the entry is evicted.
+
+_ids = LRUCache(max_size=4096)
+'''In-process cache of ('user'|'system'|'planet', *names) => id.'''
+
+
+def _get(key: Hashable, queryset: QuerySet, own: Dict[str, str], parents: Dict[str, str]) -> Model:
+    '''Gets the object of `queryset` matching both the `own` lookup (on its own
+    columns) and the `parents` lookup (on joined tables), or by the id cached for
+    `key` and `own` alone. Raises `DoesNotExist` if there is none.'''
+    object_id = _ids.get(key)
+    if object_id is not None:
+        obj = queryset.filter(id=object_id, **own).first()
+        if obj is not None:
+            return obj
+        _ids.delete(key)  # Renamed, deleted or replaced meanwhile
+    obj = queryset.get(**own, **parents)
+    _ids.set(key, obj.id)
+    return obj
+
+
+def get_user(username: str, queryset: Optional[QuerySet] = None) -> PlanetUser:
+    '''Gets the user named `username` (from `queryset`, if given; ex. to
+    `select_related()`). Raises `PlanetUser.DoesNotExist` if there is none.'''
+    return _get(('user', username), queryset if queryset is not None else PlanetUser.objects.all(),
+                {'username': username}, {})
+
+
+def get_system(username: str, systemname: str, queryset: Optional[QuerySet] = None) -> SolarSystem:
+    '''Gets the solar system `systemname` of the user `username`.
+    Raises `SolarSystem.DoesNotExist` if there is none.'''
+    return _get(('system', username, systemname),
+                queryset if queryset is not None else SolarSystem.objects.all(),
+                {'name': systemname}, {'user__username': username})
+
+
+def get_planet(username: str, systemname: str, planetname: str, queryset: Optional[QuerySet] = None) -> Planet:
+    '''Gets the planet `planetname` in the solar system `systemname` of the user
+    `username`. Raises `Planet.DoesNotExist` if there is none.'''
+    return _get(('planet', username, systemname, planetname),
+                queryset if queryset is not None else Planet.objects.all(),
+                {'name': planetname}, {'solarSystem__name': systemname, 'solarSystem__user__username': username})
+
+
+def invalidate():
+    '''Forgets all cached ids; on renames and deletes, which are rare (and may
+    affect many names at once, ex. all planets of a renamed solar system).'''
+    _ids.clear()
@@ -0,0 +1,73 @@
+import datetime
+import hashlib
+from typing import Iterable, Tuple, Union
+from django.db.models import F, Model, Q, QuerySet
+from django.http import HttpRequest
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.http import quote_etag
+from planet.models import Planet, SolarSystem, PlanetUser
+
+
+# ======================== Revision counters ===================================
+# Planets, solar systems and users have a `revision` counter and a `modified`
+# timestamp, bumped whenever their page (`view_planet`, `view_system`,
+# `view_user`) may change: when they are saved (see `Model.save()`s), and when
+# something shown on their page changes (see the signal handlers in
+# planet/models.py, and the bulk code paths that bypass them).
+# The pages' ETag and Last-Modified headers are derived from them, so that
+# browsers can revalidate pages without them being rendered again.
+
+Ids = Union[Iterable[int], QuerySet]
+'''A list of ids, or a `values()` queryset of ids (to use a subquery).'''
+
+
+def bump(model: 'Model', ids: Ids):
+    '''Bumps the revision of the objects of `model` with the given ids.'''
+    if not isinstance(ids, QuerySet):
+        ids = list(ids)
+        if not ids:
+            return
+    model.objects.filter(id__in=ids).update(revision=F('revision') + 1, modified=timezone.now())
+
+
+def bump_around_planets(planet_ids: Ids):
+    '''Bumps the revisions of the pages showing the given planets, except for
+    those of the planets themselves: their solar systems', their users' and
+    their solar systems' owners'. Two UPDATE statements.'''
+    planets = Planet.objects.filter(id__in=planet_ids)
+    bump(SolarSystem, planets.values('solarSystem'))
+    bump_planet_users(planet_ids)
+
+
+def bump_planet_users(planet_ids: Ids):
+    '''Bumps the revisions of the users of the given planets, and of the owners of
+    their solar systems. One UPDATE statement.'''
+    planets = Planet.objects.filter(id__in=planet_ids)
+    PlanetUser.objects.filter(Q(id__in=planets.values('user')) | Q(id__in=planets.values('solarSystem__user'))) \
+        .update(revision=F('revision') + 1, modified=timezone.now())
+
+
+def bump_all():
+    '''Bumps the revisions of all pages; for rare, far-reaching changes (ex.
+    renaming a user).'''
+    for model in (Planet, SolarSystem, PlanetUser):
+        model.objects.update(revision=F('revision') + 1, modified=timezone.now())
+
+
+# ======================== Conditional GET =====================================
+
+
+def page_validators(request: HttpRequest, *objects: Model) -> Tuple[str, datetime.datetime]:
+    '''Returns the ETag and Last-Modified time of a page showing `objects` (which
+    have revision counters) to the user making `request`.'''
+    fingerprint = [str(request.user.id or 0)]  # (Pages differ for their owners)
+    if request.user.is_authenticated:
+        # Their pages embed the CSRF token in forms, which is rotated on login; a
+        # page kept by the browser from before that would post a stale token
+        get_token(request)  # (Sets the CSRF cookie, if the browser has none yet)
+        fingerprint.append(request.META['CSRF_COOKIE'])
+    for obj in objects:
+        fingerprint.append(f'{type(obj).__name__}{obj.id}:{obj.revision}:{obj.modified.timestamp()}')
+    etag = quote_etag(hashlib.sha1('|'.join(fingerprint).encode()).hexdigest()[:20])
+    return etag, max(obj.modified for obj in objects)
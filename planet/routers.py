@@ -0,0 +1,101 @@
+import contextlib
+import threading
+import time
+from typing import Callable, Optional
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpRequest, HttpResponse
+
+
+# ======================== Read replica ========================================
+# If a replica of the database is configured (as `settings.REPLICA_DATABASE`;
+# see DATABASE_REPLICA_URL in WadThePlanet/database.py), the reads of GET and
+# HEAD requests (`home`, `leaderboard`, `search`, the `view_*` pages, ...) go
+# to it; everything else (writes, the reads of POST requests, management
+# commands, background jobs) goes to the primary database.
+# Replicas lag behind the primary: to let users see their own changes, requests
+# that wrote (or were not GET/HEAD) set a cookie making the next requests of
+# the same browser read from the primary for `settings.REPLICA_STICKY_SECONDS`
+# seconds (see `ReplicaMiddleware`). A request also reads from the primary
+# after writing, and code that needs fresh data can use `use_primary()`; so do
+# the fills of shared caches (the view cache, the top planets), which would
+# otherwise keep what a lagging replica returned after its invalidation.
+
+STICKY_COOKIE = 'wdp_primary_until'
+'''The cookie holding the time (a UNIX timestamp) until which the browser's
+requests read from the primary database.'''
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+_current = threading.local()
+'''The routing state of the request handled by this thread (if any): `use_replica`
+(if its reads may go to the replica) and `wrote` (if it wrote to the primary).'''
+
+
+def replica_available() -> bool:
+    '''Returns True if a replica database is configured.'''
+    return settings.REPLICA_DATABASE in connections.databases
+
+
+def reading_from_replica() -> bool:
+    '''Returns True if the reads of the current thread go to the replica.'''
+    return getattr(_current, 'use_replica', False) and not getattr(_current, 'wrote', False)
+
+
+@contextlib.contextmanager
+def use_primary():
+    '''Context manager making the reads of the current thread go to the primary database.'''
+    use_replica = getattr(_current, 'use_replica', False)
+    _current.use_replica = False
+    try:
+        yield
+    finally:
+        _current.use_replica = use_replica
+
+
+class ReplicaRouter:
+    '''Database router sending reads to the replica when the current request
+    allows it (see above), and everything else to the primary database.'''
+
+    def db_for_read(self, model, **hints) -> str:
+        if reading_from_replica() and replica_available():
+            return settings.REPLICA_DATABASE
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints) -> str:
+        _current.wrote = True  # (Read our own writes for the rest of the request)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # (The replica holds the same rows as the primary)
+        databases = (DEFAULT_DB_ALIAS, settings.REPLICA_DATABASE)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaMiddleware:
+    '''Lets GET and HEAD requests read from the replica, unless their browser
+    wrote recently; makes browsers read from the primary for a while after
+    writing (see above).'''
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        try:
+            sticky = float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        _current.use_replica = request.method in SAFE_METHODS and not sticky
+        _current.wrote = False
+        try:
+            response = self.get_response(request)
+            wrote = _current.wrote or request.method not in SAFE_METHODS
+        finally:
+            _current.use_replica = _current.wrote = False
+
+        if wrote and replica_available():
+            response.set_cookie(STICKY_COOKIE, str(time.time() + settings.REPLICA_STICKY_SECONDS),
+                                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True)
+        return response
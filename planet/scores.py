@@ -0,0 +1,84 @@
+from typing import Dict, Optional
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from planet.models import Planet, SolarSystem, PlanetUser, Comment
+from planet import leaderboard, revisions, viewcache
+
+
+def record_comment(planet_id: int, old_rating: Optional[int], new_rating: Optional[int]):
+    '''Atomically updates the comment summary and score of the planet with the
+    given id, and the score of its solar system, after one of its comments was
+    rated `new_rating` instead of `old_rating` (None for a comment that was
+    created or deleted, respectively). One UPDATE statement each, at most.
+    Also bumps the revisions of the pages showing the planet (see planet/revisions.py),
+    and invalidates their cached copies (one query); for the pages showing its
+    score (solar system, users, lists), only if the score changed.'''
+    updates = {}
+    if old_rating is None:
+        updates['comment_count'] = F('comment_count') + 1
+    if new_rating is None:
+        updates['comment_count'] = F('comment_count') - 1
+    if old_rating != new_rating:
+        # (A rating of 0 stars is no rating)
+        if old_rating:
+            updates[f'ratings_{old_rating}'] = F(f'ratings_{old_rating}') - 1
+        if new_rating:
+            updates[f'ratings_{new_rating}'] = F(f'ratings_{new_rating}') + 1
+    delta = (new_rating or 0) - (old_rating or 0)
+    if delta:
+        updates['score'] = F('score') + delta
+    now = timezone.now()
+    with transaction.atomic():
+        Planet.objects.filter(id=planet_id).update(revision=F('revision') + 1, modified=now, **updates)
+        if delta:
+            SolarSystem.objects.filter(planet__id=planet_id).update(
+                score=F('score') + delta, revision=F('revision') + 1, modified=now)
+            revisions.bump_planet_users([planet_id])
+            leaderboard.refresh_planet_rankings([planet_id])
+    viewcache.invalidate(*viewcache.planet_queryset_tags(Planet.objects.filter(id=planet_id), lists=bool(delta)))
+
+
+def comment_summary(comments: QuerySet) -> Dict[str, Coalesce]:
+    '''Returns the comment count and number of ratings of each number of stars of
+    planets among `comments`, as expressions for UPDATEs of planets (subqueries
+    correlated with the updated planet), by field name.'''
+    def count(queryset: QuerySet) -> Coalesce:
+        return Coalesce(Subquery(queryset.filter(planet=OuterRef('pk')).values('planet')
+                                 .annotate(total=Count('pk')).values('total')), 0)
+    summary = {'comment_count': count(comments)}
+    for stars in range(1, 6):
+        summary[f'ratings_{stars}'] = count(comments.filter(rating=stars))
+    return summary
+
+
+def subtract_planet_score(planet_id: int):
+    '''Atomically subtracts the (current) score of the planet with the given id
+    from the score of its solar system; to be done before deleting the planet.'''
+    planet_score = Planet.objects.filter(id=planet_id).values('score')[:1]
+    SolarSystem.objects.filter(planet__id=planet_id).update(
+        score=F('score') - Subquery(planet_score))
+    leaderboard.refresh_rankings(SolarSystem, Planet.objects.filter(id=planet_id)
+                                 .values_list('solarSystem_id', flat=True))
+
+
+def recompute_scores():
+    '''Recomputes the scores (and comment summaries) of all planets from their
+    comments' ratings, then the scores of all solar systems from their planets' scores.
+    Two bulk UPDATE statements, run in a single transaction (plus a rebuild
+    of the leaderboard's ranking table, if enabled).'''
+    rating_sums = Comment.objects.filter(planet=OuterRef('pk')) \
+        .values('planet').annotate(total=Sum('rating')).values('total')
+    planet_score_sums = Planet.objects.filter(solarSystem=OuterRef('pk')) \
+        .values('solarSystem').annotate(total=Sum('score')).values('total')
+    with transaction.atomic():
+        now = timezone.now()
+        Planet.objects.update(score=Coalesce(Subquery(rating_sums), 0),
+                              **comment_summary(Comment.objects.all()),
+                              revision=F('revision') + 1, modified=now)
+        SolarSystem.objects.update(score=Coalesce(Subquery(planet_score_sums), 0),
+                                   revision=F('revision') + 1, modified=now)
+        PlanetUser.objects.update(revision=F('revision') + 1, modified=now)
+        leaderboard.rebuild_rankings()
+        viewcache.invalidate(viewcache.ALL)
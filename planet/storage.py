@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Iterable, List, Optional
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from planet import textures
+
+
+# ======================== Texture storage =====================================
+# Planet textures are stored by content: the name of a saved texture is the hash
+# of its content (ex. `planets/3f/3f9a...c2.jpg`), so identical textures are
+# stored once and shared by all planets that use them (and get the same URL,
+# hence the same CDN/browser cache entries).
+# A texture's reference count is the number of planets using it; it is only
+# deleted once that drops to zero. Textures that could not be deleted right
+# away, as they were (re)saved too recently, are queued to be retried once they
+# are old enough (see `jobs.retry_texture_cleanup()`); those left behind (ex. by a
+# process that exited meanwhile) are removed later by `manage.py gc_textures`.
+
+logger = logging.getLogger(__name__)
+
+
+@deconstructible
+class TextureStorage(FileSystemStorage):
+    '''A `FileSystemStorage` that stores planet textures by content hash and
+    only deletes them when no planet references them anymore.'''
+
+    def content_name(self, name: str, content: File) -> str:
+        '''Returns the name `content` is stored as; `name` only provides the
+        directory and extension. (Note that texture jobs may resize a texture
+        in place later: the name is the hash of the content as uploaded.)'''
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        digest = digest.hexdigest()
+        directory, filename = os.path.split(name)
+        ext = os.path.splitext(filename)[1].lower() or '.jpg'
+        return os.path.join(directory, digest[:2], digest + ext)
+
+    def save(self, name: str, content: File, max_length: int = None) -> str:
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.content_name(name, content)
+        if self.exists(name):
+            # Already stored: share it. Touch it, so that a concurrent delete
+            # of its last reference leaves it alone (see `delete()`)
+            os.utime(self.path(name))
+            return name
+        return self._save(name, content)
+
+    def _save(self, name: str, content: File) -> str:
+        # Write to a temporary file, then move it in place; concurrent saves of
+        # the same content write the same bytes, so the last one can just win
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.chmod(tmp_path, self.file_permissions_mode or 0o644)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return name
+
+    def references(self, name: str) -> int:
+        '''Returns the reference count of the texture named `name`.'''
+        from planet.models import Planet
+        return Planet.objects.filter(texture=name).count()
+
+    def is_collectable(self, name: str) -> bool:
+        '''Returns True if the texture named `name` can be deleted: nothing
+        references it, and it was not (re)saved in the last
+        `settings.TEXTURE_GC_GRACE_PERIOD` seconds.'''
+        return self._old_enough(name) and self.references(name) == 0
+
+    def _age(self, name: str) -> Optional[float]:
+        '''Returns the number of seconds since the texture named `name` was
+        (re)saved, or None if it does not exist.'''
+        try:
+            return time.time() - os.path.getmtime(self.path(name))
+        except FileNotFoundError:
+            return None
+
+    def _old_enough(self, name: str) -> bool:
+        age = self._age(name)
+        return age is not None and age >= settings.TEXTURE_GC_GRACE_PERIOD
+
+    def collectable(self, names: Iterable[str]) -> List[str]:
+        '''Like `is_collectable()`, for many textures at once; returns the names
+        of those that can be deleted.'''
+        from planet.models import Planet
+        names = [name for name in set(names) if self._old_enough(name)]
+        referenced = set()
+        for i in range(0, len(names), 500):  # (Keep below SQLite's limit on query parameters)
+            referenced.update(Planet.objects.filter(texture__in=names[i:i + 500])
+                              .values_list('texture', flat=True))
+        return [name for name in names if name not in referenced]
+
+    def delete(self, name: str):
+        '''Deletes the texture named `name` and its derivatives, unless it is
+        still referenced; if it is too recent (see `is_collectable()`), retries
+        once it is old enough.'''
+        age = self._age(name)
+        if age is None:
+            return  # (Already deleted)
+        if self.references(name):
+            logger.debug(f'{name}: still in use, not deleting it')
+            return
+        if age < settings.TEXTURE_GC_GRACE_PERIOD:
+            logger.debug(f'{name}: saved {age:.0f}s ago, retrying the deletion later')
+            from planet import jobs
+            jobs.retry_texture_cleanup([name])
+            return
+        super().delete(name)
+        textures.delete_derivatives(name)
+
+
+texture_storage = TextureStorage()
+'''The storage of `Planet.texture`.'''
@@ -11,4 +11,10 @@ def star_rating(rating: int) -> str:
     elif rating > 5:
         return 'Invalid rating'
     else:
-        return f'{"🟊" * rating}{"☆" * (5 - rating)}'
\ No newline at end of file
+        return f'{"🟊" * rating}{"☆" * (5 - rating)}'
+
+@register.filter(name='thumbnail')
+def thumbnail(planet: 'Planet', size: int) -> str:
+    '''A custom template filter that returns the URL of the smallest thumbnail
+    of `planet`'s texture that is at least `size` pixels wide.'''
+    return planet.thumbnail_url(int(size))
@@ -0,0 +1,130 @@
+import io
+import random
+from typing import List, Optional, Tuple
+import numpy as np
+from PIL import Image
+from planet.metrics import timed
+
+
+# ======================== Procedural textures =================================
+# New planets start with a procedurally generated texture: fractal (fBm) value
+# noise, mapped to the colors of a (randomly jittered) palette. The noise wraps
+# around horizontally, as the texture is wrapped around the sphere.
+# Everything is vectorized with NumPy; the noise is computed at a lower
+# resolution (`detail`) and the colored image is upscaled by Pillow. Most of the
+# time then goes to JPEG encoding, so the textures of new planets (see
+# `generate_planet_texture_jpeg()`) are generated at full size with coarser
+# noise and a cheaper encode; the texture job keeps them as they are.
+# See `manage.py benchmark_texturegen`.
+
+PALETTES = {
+    'terran': [(0.00, (8, 24, 80)), (0.46, (28, 84, 164)), (0.50, (214, 202, 146)),
+               (0.54, (66, 132, 48)), (0.72, (34, 86, 36)), (0.86, (112, 98, 86)),
+               (0.94, (240, 240, 244)), (1.00, (255, 255, 255))],
+    'desert': [(0.00, (96, 48, 24)), (0.35, (168, 96, 48)), (0.60, (214, 164, 96)),
+               (0.80, (236, 206, 148)), (1.00, (255, 240, 210))],
+    'ice': [(0.00, (40, 72, 120)), (0.40, (120, 168, 210)), (0.65, (210, 230, 244)),
+            (1.00, (255, 255, 255))],
+    'lava': [(0.00, (18, 12, 12)), (0.55, (52, 32, 28)), (0.70, (96, 24, 8)),
+             (0.82, (220, 72, 8)), (1.00, (255, 220, 96))],
+    'gas': [(0.00, (110, 70, 40)), (0.30, (190, 140, 90)), (0.50, (238, 214, 176)),
+            (0.70, (170, 110, 70)), (1.00, (240, 228, 210))],
+}
+'''Kinds of planets => their palette, as (noise value, RGB color) stops.'''
+
+Palette = List[Tuple[float, Tuple[int, int, int]]]
+
+NEW_PLANET_DETAIL = 256
+'''The noise resolution (in pixels) of the textures of new planets.'''
+
+NEW_PLANET_QUALITY = 85
+'''The JPEG quality of the textures of new planets (encoded without `optimize`, which costs more time than it saves bytes).'''
+
+
+def random_palette(rng: random.Random, kind: str) -> Palette:
+    '''Returns the palette for `kind`, with its colors randomly jittered.'''
+    shift = [rng.randint(-24, 24) for _ in range(3)]
+    return [(stop, tuple(min(max(c + s + rng.randint(-8, 8), 0), 255) for c, s in zip(color, shift)))
+            for stop, color in PALETTES[kind]]
+
+
+def _interpolation(size: int, cells: int, wrap: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Returns the indices of the two grid cells surrounding each of `size`
+    pixels, and the (smoothstepped) interpolation weights between them.'''
+    coords = (np.arange(size, dtype=np.float32) + 0.5) * (cells / size)
+    i0 = np.floor(coords).astype(np.int32)
+    t = coords - i0
+    i1 = i0 + 1
+    if wrap:
+        i0 %= cells
+        i1 %= cells
+    else:
+        i0 = np.minimum(i0, cells - 1)
+        i1 = np.minimum(i1, cells - 1)
+    return i0, i1, t * t * (3 - 2 * t)
+
+
+def fbm(np_rng: np.random.RandomState, size: int, octaves: int = 6,
+        base_cells: int = 4, persistence: float = 0.5) -> np.ndarray:
+    '''Returns `size`x`size` fractal value noise (a float32 array, in [0, 1])
+    that wraps around horizontally.'''
+    total = np.zeros((size, size), dtype=np.float32)
+    amplitude, cells = 1.0, base_cells
+    for _ in range(octaves):
+        cells = min(cells, size)
+        grid = np_rng.random_sample((cells, cells)).astype(np.float32)
+        # Separable (smoothed) bilinear interpolation: first along x, then along y
+        x0, x1, tx = _interpolation(size, cells, wrap=True)
+        rows = grid[:, x0] + (grid[:, x1] - grid[:, x0]) * tx
+        y0, y1, ty = _interpolation(size, cells, wrap=False)
+        total += amplitude * (rows[y0] + (rows[y1] - rows[y0]) * ty[:, np.newaxis])
+        amplitude *= persistence
+        cells *= 2
+
+    total -= total.min()
+    total /= max(total.max(), 1e-6)
+    return total
+
+
+@timed('generate_texture')
+def generate_texture(size: int = 2048, seed: Optional[int] = None, kind: Optional[str] = None,
+                     detail: int = 512) -> Image.Image:
+    '''Generates a random `size`x`size` planet texture (RGB); the same `seed`
+    always gives the same texture. `kind` is a key of `PALETTES` (random if None).
+    The noise is computed at `detail`x`detail` pixels (at most) and upscaled.'''
+    rng = random.Random(seed)
+    np_rng = np.random.RandomState(rng.getrandbits(32))
+    kind = kind or rng.choice(sorted(PALETTES))
+    noise_size = min(size, detail)
+
+    noise = fbm(np_rng, noise_size, base_cells=rng.choice([2, 4, 8]),
+                persistence=rng.uniform(0.4, 0.6))
+    if kind == 'gas':
+        # Gas giants are banded by latitude
+        latitude = np.linspace(0, np.pi * rng.randint(4, 12), noise_size, dtype=np.float32)
+        noise = 0.35 * noise + 0.65 * (0.5 + 0.5 * np.sin(latitude[:, np.newaxis] + 3 * noise))
+
+    # Map the noise to the palette's colors through a 256-color lookup table
+    stops, colors = zip(*random_palette(rng, kind))
+    levels = np.linspace(0, 1, 256)
+    lut = np.stack([np.interp(levels, stops, channel) for channel in zip(*colors)], axis=1)
+    indices = Image.fromarray((noise * 255).astype(np.uint8), 'L')
+    lut = np.round(lut).astype(np.uint8)
+    img = Image.merge('RGB', [indices.point(lut[:, channel].tolist()) for channel in range(3)])
+
+    if noise_size != size:
+        img = img.resize((size, size), resample=Image.BILINEAR)
+    return img
+
+
+def generate_texture_jpeg(size: int = 2048, seed: Optional[int] = None, quality: int = 90, **kwargs) -> bytes:
+    '''Like `generate_texture()`, but returns the texture JPEG-encoded.'''
+    out = io.BytesIO()
+    generate_texture(size, seed, **kwargs).save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+def generate_planet_texture_jpeg(size: int, seed: Optional[int] = None) -> bytes:
+    '''Returns the (JPEG-encoded) texture of a new planet, as created by
+    `views.create_planet`; at full `size`, so the texture job does not re-encode it.'''
+    return generate_texture_jpeg(size, seed, quality=NEW_PLANET_QUALITY, detail=NEW_PLANET_DETAIL)
@@ -0,0 +1,251 @@
+import io
+import json
+import logging
+import os
+import struct
+import time
+from typing import IO, Dict, Iterable, List, Optional, Tuple
+from PIL import Image
+from django.conf import settings
+from planet.caching import LRUCache
+from planet.metrics import timed
+
+
+# ======================== Utilities ===========================================
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = (1024, 256, 64)
+'''Sizes (in pixels, square) of the derivatives generated for each planet texture.
+Largest first, so that each one can be downscaled from the previous one.'''
+
+THUMBNAIL_DIR = 'thumbs'
+'''Directory (relative to MEDIA_ROOT) where the derivatives are stored.'''
+
+PYRAMID_DIR = 'tiles'
+'''Directory (relative to MEDIA_ROOT) where the tile pyramids are stored.'''
+
+PYRAMID_MAGIC = b'WDPT'
+'''The first bytes of a tile pyramid file.'''
+
+PYRAMID_MIN_SIZE = 64
+'''The size (in pixels) of the smallest level of a tile pyramid.'''
+
+_pyramid_headers = LRUCache(max_size=256)
+'''In-process cache of (pyramid path, inode, mtime) => pyramid header.'''
+
+
+def thumbnail_name(texture_name: str, size: int) -> str:
+    '''Returns the name (relative to MEDIA_ROOT) of the `size`x`size` derivative
+    of the texture named `texture_name`. The name only depends on the texture's
+    name, so it is a stable address for the thumbnail.'''
+    base, _ = os.path.splitext(texture_name)
+    return os.path.join(THUMBNAIL_DIR, str(size), base + '.jpg')
+
+
+def thumbnail_path(texture_name: str, size: int) -> str:
+    '''Like `thumbnail_name()`, but returns an absolute path on disk.'''
+    return os.path.join(settings.MEDIA_ROOT, thumbnail_name(texture_name, size))
+
+
+def nearest_thumbnail_size(size: int) -> int:
+    '''Returns the smallest available thumbnail size that is at least `size`
+    pixels wide (or the largest one if `size` is bigger than all of them).'''
+    fitting = [s for s in THUMBNAIL_SIZES if s >= size]
+    return min(fitting) if fitting else max(THUMBNAIL_SIZES)
+
+
+@timed('generate_thumbnails')
+def generate_thumbnails(texture_name: str, sizes: Iterable[int] = THUMBNAIL_SIZES):
+    '''(Re)generates the derivatives for the texture named `texture_name`.'''
+    src_path = os.path.join(settings.MEDIA_ROOT, texture_name)
+    with Image.open(src_path) as pil_img:
+        # For JPEGs, let the decoder do most of the downscaling for us (DCT scaling)
+        pil_img.draft('RGB', (max(sizes), max(sizes)))
+        img = pil_img.convert('RGB')
+
+    for size in sorted(sizes, reverse=True):
+        img = img.resize((size, size), resample=Image.LANCZOS)
+        dest_path = thumbnail_path(texture_name, size)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        img.save(dest_path, 'JPEG', quality=85, optimize=True)
+    logger.debug(f'{texture_name}: generated thumbnails {sorted(sizes)}')
+
+
+def delete_derivatives(texture_name: str):
+    '''Deletes all derivatives (thumbnails and tile pyramid) of the texture named
+    `texture_name` (if any).'''
+    for path in [thumbnail_path(texture_name, size) for size in THUMBNAIL_SIZES] + \
+                [pyramid_path(texture_name)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def delete_textures(texture_names: List[str], min_age: float = 0):
+    '''Deletes the textures with the given names, along with their derivatives;
+    skips those modified less than `min_age` seconds ago.
+    Does not touch the database, so that it can be run in a worker process.'''
+    for texture_name in texture_names:
+        path = os.path.join(settings.MEDIA_ROOT, texture_name)
+        try:
+            if min_age and time.time() - os.path.getmtime(path) < min_age:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        delete_derivatives(texture_name)
+    logger.debug(f'Deleted {len(texture_names)} texture(s)')
+
+
+def process_texture(texture_name: str, texture_size: int) -> float:
+    '''Resizes the texture named `texture_name` to `texture_size`x`texture_size`
+    and re-encodes it as a JPEG if it has the wrong size or format (uploads that
+    are already correctly sized JPEGs are kept as they are), then regenerates its
+    thumbnails.
+    Does not touch the database, so that it can be run in a worker process.
+    Returns the time it took, in seconds, which the caller records (as a worker's
+    metrics are not exported; see `jobs.run_job()`).'''
+    start = time.perf_counter()
+    src_path = os.path.join(settings.MEDIA_ROOT, texture_name)
+    with Image.open(src_path) as pil_img:
+        width, height = pil_img.size
+        if width != texture_size or height != texture_size or pil_img.format != 'JPEG':
+            # Rescale image to correct size and save
+            logger.debug(f'{texture_name}: Image is a {width}x{height} {pil_img.format},'
+                         f'converting it to a {texture_size}x{texture_size} JPEG')
+            resized = pil_img.convert('RGB')
+            if resized.size != (texture_size, texture_size):
+                resized = resized.resize((texture_size, texture_size), resample=Image.BICUBIC)
+            resized.save(src_path, 'JPEG', quality=90, optimize=True)
+
+    generate_thumbnails(texture_name)
+    generate_pyramid(texture_name)
+    return time.perf_counter() - start
+
+
+@timed('composite_tiles')
+def composite_tiles(texture_name: str, tiles: Iterable[Tuple[int, int, IO]],
+                    texture_size: int, tile_size: int) -> bytes:
+    '''Pastes the given `(x, y, image file)` tiles (with `x`, `y` in tile units)
+    over the texture named `texture_name`; returns the result, JPEG-encoded.
+    Raises ValueError on invalid tiles.'''
+    tiles_per_side = texture_size // tile_size
+    src_path = os.path.join(settings.MEDIA_ROOT, texture_name)
+    with Image.open(src_path) as pil_img:
+        img = pil_img.convert('RGB')
+    if img.size != (texture_size, texture_size):
+        # (The texture may not have been processed yet)
+        img = img.resize((texture_size, texture_size), resample=Image.BICUBIC)
+
+    for x, y, tile_file in tiles:
+        if not (0 <= x < tiles_per_side and 0 <= y < tiles_per_side):
+            raise ValueError(f'Tile ({x}, {y}) out of bounds')
+        try:
+            with Image.open(tile_file) as tile_img:
+                if tile_img.size != (tile_size, tile_size):
+                    raise ValueError(f'Tile ({x}, {y}) has wrong size {tile_img.size}')
+                img.paste(tile_img.convert('RGB'), (x * tile_size, y * tile_size))
+        except OSError:
+            raise ValueError(f'Tile ({x}, {y}) is not a valid image')
+
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=90, optimize=True)
+    return out.getvalue()
+
+
+# ======================== Tile pyramids =======================================
+# A tile pyramid stores the texture at decreasing resolutions (levels), halving
+# the size each time down to `PYRAMID_MIN_SIZE`; each level is split in square
+# JPEG tiles. The file layout is:
+#   PYRAMID_MAGIC | header length (uint32, little-endian) | JSON header | tiles
+# where the header is `{"tile_size": ..., "levels": [{"size": ..., "tiles": [[offset, length], ...]}]}`,
+# tiles are listed row by row and offsets are relative to the end of the header.
+# Any tile can hence be read (or requested with a HTTP Range) by offset; the tiles
+# of a level are contiguous, so editor.js requests each level with a single Range.
+
+
+def pyramid_name(texture_name: str) -> str:
+    '''Returns the name (relative to MEDIA_ROOT) of the tile pyramid of the texture
+    named `texture_name`.'''
+    base, _ = os.path.splitext(texture_name)
+    return os.path.join(PYRAMID_DIR, base + '.wdpt')
+
+
+def pyramid_path(texture_name: str) -> str:
+    '''Like `pyramid_name()`, but returns an absolute path on disk.'''
+    return os.path.join(settings.MEDIA_ROOT, pyramid_name(texture_name))
+
+
+@timed('generate_pyramid')
+def generate_pyramid(texture_name: str, tile_size: int = 256):
+    '''(Re)generates the tile pyramid for the texture named `texture_name`.'''
+    src_path = os.path.join(settings.MEDIA_ROOT, texture_name)
+    with Image.open(src_path) as pil_img:
+        img = pil_img.convert('RGB')
+
+    levels, blobs, offset = [], [], 0
+    while True:
+        size = img.size[0]
+        tiles = []
+        for y in range(0, size, tile_size):
+            for x in range(0, size, tile_size):
+                out = io.BytesIO()
+                img.crop((x, y, min(x + tile_size, size), min(y + tile_size, size))) \
+                   .save(out, 'JPEG', quality=85, optimize=True)
+                blob = out.getvalue()
+                tiles.append([offset, len(blob)])
+                blobs.append(blob)
+                offset += len(blob)
+        levels.append({'size': size, 'tiles': tiles})
+        if size // 2 < PYRAMID_MIN_SIZE:
+            break
+        img = img.resize((size // 2, size // 2), resample=Image.LANCZOS)
+
+    header = json.dumps({'tile_size': tile_size, 'levels': levels}).encode()
+    dest_path = pyramid_path(texture_name)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_path = dest_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PYRAMID_MAGIC + struct.pack('<I', len(header)) + header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, dest_path)  # (Atomically, for concurrent readers)
+    logger.debug(f'{texture_name}: generated tile pyramid with {len(levels)} levels')
+
+
+def _read_pyramid_header(f: IO) -> Dict:
+    if f.read(len(PYRAMID_MAGIC)) != PYRAMID_MAGIC:
+        raise ValueError('Not a tile pyramid')
+    header_length, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(header_length).decode())
+    header['data_offset'] = len(PYRAMID_MAGIC) + 4 + header_length
+    return header
+
+
+def read_pyramid_tile(texture_name: str, level: int, x: int, y: int) -> Optional[bytes]:
+    '''Returns the (JPEG-encoded) tile at column `x`, row `y` of the given `level`
+    (0 = full size) of the tile pyramid of the texture named `texture_name`.
+    Returns None if there is no such pyramid or tile.'''
+    path = pyramid_path(texture_name)
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            key = (path, stat.st_ino, stat.st_mtime_ns)
+            header = _pyramid_headers.get(key)
+            if header is None:
+                header = _read_pyramid_header(f)
+                _pyramid_headers.set(key, header)
+
+            if not 0 <= level < len(header['levels']):
+                return None
+            level_info = header['levels'][level]
+            tiles_per_side = -(-level_info['size'] // header['tile_size'])  # (Rounding up)
+            if not (0 <= x < tiles_per_side and 0 <= y < tiles_per_side):
+                return None
+            offset, length = level_info['tiles'][y * tiles_per_side + x]
+            f.seek(header['data_offset'] + offset)
+            return f.read(length)
+    except FileNotFoundError:
+        return None
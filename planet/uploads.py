@@ -0,0 +1,152 @@
+import io
+import logging
+from typing import IO, NamedTuple, Optional
+from PIL import Image
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+# ======================== Upload validation ===================================
+# Uploaded images (planet textures, texture tiles and avatars) are checked from
+# their header alone before anything decodes them, so that decompression bombs
+# and oversized images never get decoded.
+# Django keeps uploads of up to FILE_UPLOAD_MAX_MEMORY_SIZE bytes in memory and
+# streams larger ones to temporary files; `ImageUploadHandler` comes first in
+# FILE_UPLOAD_HANDLERS and sniffs the header of each upload as it streams in,
+# stopping to store uploads that are too large or not acceptable images. The
+# views and forms then validate each upload for its use (ex. `validate_texture()`),
+# re-reading only its header.
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+'''The (Pillow) formats accepted for uploaded images.'''
+
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'RIFF')
+'''The first bytes of the files in `IMAGE_FORMATS` (WebP files start with a RIFF header).'''
+
+HEADER_MAX_SIZE = 256 * 1024
+'''How many bytes of an upload are buffered, at most, to find its size (JPEG
+headers may be preceded by large EXIF/ICC segments).'''
+
+AVATAR_MAX_SIZE = 4096
+'''The maximum width/height (in pixels) of avatars; they are shown scaled down.'''
+
+# Pillow refuses to open images of over twice as many pixels (with a DecompressionBombError)
+Image.MAX_IMAGE_PIXELS = settings.UPLOAD_MAX_IMAGE_PIXELS
+
+
+class ImageInfo(NamedTuple):
+    '''The format and size of an image, as read from its header.'''
+    format: str
+    width: int
+    height: int
+
+
+def parse_header(data: bytes, complete: bool = False) -> Optional[ImageInfo]:
+    '''Returns the format and size of the image starting with `data`, or None if
+    more bytes are needed to tell (unless `complete`, i.e. there are no more).
+    Raises ValidationError if `data` is not the start of an acceptable image.'''
+    if len(data) >= 12 and not (data.startswith(IMAGE_SIGNATURES[:-1]) or
+                                (data.startswith(b'RIFF') and data[8:12] == b'WEBP')):
+        raise ValidationError('Upload a JPEG, PNG, GIF or WebP image.')
+    try:
+        # (Only reads the header; the image is decoded lazily, when its pixels are needed)
+        with Image.open(io.BytesIO(data)) as img:
+            info = ImageInfo(img.format, *img.size)
+    except Image.DecompressionBombError:
+        raise ValidationError('The image has too many pixels.')
+    except (OSError, SyntaxError, ValueError):
+        if complete or len(data) >= HEADER_MAX_SIZE:
+            raise ValidationError('Upload a valid image. The file is not an image, or is corrupted.')
+        return None  # (The header may be truncated)
+
+    if info.format not in IMAGE_FORMATS:
+        raise ValidationError('Upload a JPEG, PNG, GIF or WebP image.')
+    if info.width * info.height > settings.UPLOAD_MAX_IMAGE_PIXELS:
+        raise ValidationError(f'The image is too large ({info.width}x{info.height} pixels).')
+    return info
+
+
+class RejectedUpload(UploadedFile):
+    '''Stands for an upload that `ImageUploadHandler` stopped storing; `error` says why.'''
+
+    def __init__(self, name: str, content_type: str, error: ValidationError):
+        super().__init__(io.BytesIO(), name, content_type, 0)
+        self.error = error
+
+
+class ImageUploadHandler(FileUploadHandler):
+    '''Upload handler checking uploads as they stream in, before the next handlers
+    store them: uploads larger than `settings.UPLOAD_MAX_SIZE` bytes and those
+    whose header is not that of an acceptable image (see `parse_header()`) are
+    replaced by a `RejectedUpload`, and their remaining data is discarded.'''
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.header = b''
+        self.checked = False
+        self.error = None
+
+    def receive_data_chunk(self, raw_data: bytes, start: int) -> Optional[bytes]:
+        if self.error is not None:
+            return None
+        try:
+            if start + len(raw_data) > settings.UPLOAD_MAX_SIZE:
+                raise ValidationError(f'The file is too large (over {settings.UPLOAD_MAX_SIZE // 1024} KB).')
+            if not self.checked:
+                self.header += raw_data
+                self.checked = parse_header(self.header) is not None
+                if self.checked:
+                    self.header = b''
+        except ValidationError as e:
+            logger.info(f'Rejected upload {self.file_name}: {e.messages[0]}')
+            self.error = e
+            return None  # (Stops passing the data to the next handlers)
+        return raw_data
+
+    def file_complete(self, file_size: int) -> Optional[UploadedFile]:
+        if self.error is None and not self.checked:
+            try:
+                parse_header(self.header, complete=True)
+            except ValidationError as e:
+                self.error = e
+        if self.error is not None:
+            return RejectedUpload(self.file_name, self.content_type, self.error)
+        return None  # (Let the next handler return the stored file)
+
+
+def sniff_image(f: IO) -> ImageInfo:
+    '''Returns the format and size of the uploaded image `f` from its header.
+    Raises ValidationError if it was rejected or is not an acceptable image.'''
+    if isinstance(f, RejectedUpload):
+        raise f.error
+    if getattr(f, 'size', None) is not None and f.size > settings.UPLOAD_MAX_SIZE:
+        raise ValidationError(f'The file is too large (over {settings.UPLOAD_MAX_SIZE // 1024} KB).')
+    f.seek(0)
+    header = f.read(HEADER_MAX_SIZE)
+    f.seek(0)
+    return parse_header(header, complete=True)
+
+
+def validate_texture(f: IO, texture_size: int, min_size: int) -> ImageInfo:
+    '''Checks that `f` is an acceptable planet texture: a square image of
+    `min_size` to `texture_size` pixels per side. Textures that are not
+    `texture_size`x`texture_size` JPEGs are re-encoded by the texture job;
+    others are stored as they are.'''
+    info = sniff_image(f)
+    if info.width != info.height or not (min_size <= info.width <= texture_size):
+        raise ValidationError(f'Textures must be square, and from {min_size}x{min_size} to '
+                              f'{texture_size}x{texture_size} pixels (not {info.width}x{info.height}).')
+    return info
+
+
+def validate_avatar(f: IO) -> ImageInfo:
+    '''Checks that `f` is an acceptable avatar (of at most `AVATAR_MAX_SIZE` pixels per side).'''
+    info = sniff_image(f)
+    if info.width > AVATAR_MAX_SIZE or info.height > AVATAR_MAX_SIZE:
+        raise ValidationError(f'Avatars must be at most {AVATAR_MAX_SIZE}x{AVATAR_MAX_SIZE} pixels '
+                              f'(not {info.width}x{info.height}).')
+    return info
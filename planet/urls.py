@@ -11,9 +11,11 @@ urlpatterns = [
     url(r'^register/$', views.register, name='register'),
     url(r'^login/$', views.user_login, name='login'),
     url(r'^search/$', views.search, name='search'),
+    url(r'^search/suggest/$', views.search_suggest, name='search_suggest'),
 
     url(r'^contact/', views.contact, name='contact'),
     url(r'^logout/$', views.user_logout, name='logout'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
 
     # /<username>/*
     url(r'^(?P<username>[A-Za-z0-9]+)/edit/$',
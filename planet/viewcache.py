@@ -0,0 +1,139 @@
+import functools
+import hashlib
+import uuid
+from typing import Callable, Dict, Iterable, List
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import QuerySet
+from django.http import HttpRequest, HttpResponse
+from planet import routers
+
+
+# ======================== View cache ==========================================
+# The responses of the main pages are cached for anonymous users, keyed by view,
+# URL (including the query string) and the current versions of the *tags* the
+# page depends on (ex. `planet:Bob/BobsSystem/Mars` for the page of that planet).
+# The signal handlers in planet/models.py invalidate exactly the tags affected by
+# a change, by giving them a new version; the stale responses are never read
+# again, and expire on their own.
+
+PLANETS = 'planets'
+'''Tag of the pages listing planets from all users (home, leaderboard).'''
+
+SYSTEMS = 'systems'
+'''Tag of the pages listing solar systems from all users (leaderboard).'''
+
+ALL = 'all'
+'''Tag that all pages depend on; for rare, far-reaching changes (ex. renaming a user).'''
+
+
+def user_tag(username: str) -> str:
+    return f'user:{username}'
+
+
+def system_tag(username: str, systemname: str) -> str:
+    return f'system:{username}/{systemname}'
+
+
+def planet_tag(username: str, systemname: str, planetname: str) -> str:
+    return f'planet:{username}/{systemname}/{planetname}'
+
+
+def _cache():
+    return caches[settings.VIEW_CACHE]
+
+
+def _versions(tags: List[str]) -> Dict[str, str]:
+    '''Returns the current version of each tag, creating the missing ones.'''
+    keys = {f'viewcache:tag:{tag}': tag for tag in tags}
+    versions = _cache().get_many(keys)
+    missing = {key: uuid.uuid4().hex for key in keys if key not in versions}
+    if missing:
+        # (A new random version, as the tag may have been evicted rather than never set)
+        _cache().set_many(missing, timeout=None)
+        versions.update(missing)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def _bump(tags: Iterable[str]):
+    _cache().set_many({f'viewcache:tag:{tag}': uuid.uuid4().hex for tag in tags}, timeout=None)
+
+
+def invalidate(*tags: str):
+    '''Invalidates all cached pages depending on any of `tags`; both right away
+    and once the current transaction commits (in case a concurrent request
+    cached the page again in between).'''
+    if not tags:
+        return
+    _bump(tags)
+    transaction.on_commit(lambda: _bump(tags))
+
+
+def cache_view(tags: Callable[..., List[str]]):
+    '''Decorator that caches the responses of a view for anonymous users;
+    `tags(*args, **kwargs)` returns the tags of the page for the view's arguments.
+    Only successful GET responses that do not set cookies are cached; they are
+    rendered reading from the primary database (see planet/routers.py).'''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+            if request.method != 'GET' or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            versions = _versions([ALL] + tags(*args, **kwargs))
+            fingerprint = '|'.join([view.__name__, request.get_full_path()] +
+                                   [f'{tag}={version}' for tag, version in sorted(versions.items())])
+            key = 'viewcache:response:' + hashlib.sha1(fingerprint.encode()).hexdigest()
+            response = _cache().get(key)
+            if response is not None:
+                return response
+
+            # (From the primary database: a lagging replica could fill the cache with a
+            # page from before the change that just gave its tags a new version)
+            with routers.use_primary():
+                response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming and not response.cookies \
+                    and not request.META.get('CSRF_COOKIE_USED'):
+                _cache().set(key, response, settings.VIEW_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
+
+
+# ======================== Tags of objects =====================================
+
+
+def planet_tags(planet) -> List[str]:
+    '''Returns the tags of the pages showing `planet` (or its comments).'''
+    system = planet.solarSystem
+    owner = system.user.username
+    return [PLANETS, SYSTEMS, user_tag(planet.user.username), user_tag(owner),
+            system_tag(owner, system.name), planet_tag(owner, system.name, planet.name)]
+
+
+def planet_queryset_tags(planets: QuerySet, lists: bool = True) -> List[str]:
+    '''Like `planet_tags()`, for all planets in the queryset (in a single query).
+    If not `lists`, leaves out the tags of the pages listing all planets/systems.'''
+    tags = set()
+    for name, username, systemname, owner in planets.values_list(
+            'name', 'user__username', 'solarSystem__name', 'solarSystem__user__username'):
+        tags.update([user_tag(username), user_tag(owner),
+                     system_tag(owner, systemname), planet_tag(owner, systemname, name)])
+    if tags and lists:
+        tags.update([PLANETS, SYSTEMS])
+    return list(tags)
+
+
+def system_tags(system) -> List[str]:
+    '''Returns the tags of the pages showing `system`.'''
+    owner = system.user.username
+    return [SYSTEMS, user_tag(owner), system_tag(owner, system.name)]
+
+
+def user_tags(user) -> List[str]:
+    '''Returns the tags of the pages showing `user` (or his avatar).'''
+    from planet.models import Planet
+    return [user_tag(user.username)] + \
+        [system_tag(user.username, name) for name in user.solarsystem_set.values_list('name', flat=True)] + \
+        planet_queryset_tags(Planet.objects.filter(comment__user=user), lists=False)
@@ -3,17 +3,28 @@ import re
 import logging
 import os
 import functools
-from typing import List
+from typing import Callable, List
 from django.shortcuts import render, reverse
 from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden ,HttpResponseNotFound
-from planet.webhose_search import run_query
+from planet.webhose_search import run_query, suggest
+from planet.leaderboard import invalidate_top_planets, keyset_page, leaderboard_page, top_planet_ids
 from planet.models import Planet, Comment, PlanetUser, SolarSystem
 from planet.forms import LoggingForm, RegistrationForm, CommentForm, SolarSystemForm, EditUserForm, LeaderboardForm, PlanetForm
 from django.contrib import messages, auth
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
-from django.http import Http404
+from django.http import Http404, JsonResponse
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.static import serve
+from django.db import transaction
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from planet import deletion, jobs, metrics as request_metrics, resolvers, revisions, textures, uploads
+from planet.viewcache import cache_view, PLANETS, SYSTEMS, user_tag, system_tag, planet_tag
 
 
 # ======================== Utilities ===========================================
@@ -21,12 +32,37 @@ from django.http import Http404
 logger = logging.getLogger(__name__)  # A utility logger
 HOST = 'http://wdp.pythonanywhere.com/'  # The URL of the website when hosted.
                                          # Required for social media sharing buttons to work.
-
-def get_mvps(model: 'Model', criteria: str='-score') -> List:
-    '''Gets the object[s] with the best `criteria` from the given model,
-    excluding those that have `visibility=False`.
-    '''
-    return model.objects.exclude(visibility=False).order_by(criteria)
+TILE_KEY_RE = re.compile(r'^tile_(\d+)_(\d+)$')  # Names of the texture tiles uploaded by editor.js
+TILE_SAVE_ATTEMPTS = 3  # Times to composite uploaded tiles if the texture keeps changing meanwhile
+
+# Related objects to fetch along with planets/systems; these are accessed when
+# rendering them (ex. in planettemplate.html), and would otherwise cost one query each
+PLANET_RELATED = ('user', 'solarSystem__user')
+SYSTEM_RELATED = ('user',)
+
+# Fields of a planet that change when its texture is saved (see `Planet.save()`)
+TEXTURE_FIELDS = ['texture', 'processing', 'revision', 'modified']
+
+# Media directories whose files never change (once processed; see `serve_media()`)
+IMMUTABLE_MEDIA_DIRS = ('planets/', textures.THUMBNAIL_DIR + '/', textures.PYRAMID_DIR + '/')
+
+def page_response(request: HttpRequest, objects: List, render_page: Callable[[], HttpResponse]) -> HttpResponse:
+    '''Returns `render_page()`, a page showing `objects` (which have revision counters),
+    with ETag and Last-Modified headers; or a 304 Not Modified if the client's copy
+    is still current, without rendering the page (see planet/revisions.py).'''
+    if request.method not in ('GET', 'HEAD'):
+        return render_page()
+    etag, last_modified = revisions.page_validators(request, *objects)
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+    if response is None:
+        response = render_page()
+        if response.status_code != 200:
+            return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified.timestamp())
+    # Browsers should revalidate pages every time (which is cheap)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 def render_error(request: HttpRequest, message: str) -> HttpResponse:
     '''Renders an error page with the given message.'''
@@ -40,59 +76,77 @@ def render_delete_page(request: HttpRequest, message: str, post_url: str) -> Htt
 # ======================== Views ===============================================
 
 
+@cache_view(lambda: [PLANETS])
 def home(request: HttpRequest) -> HttpResponse:
     '''
-    Shows an index/landing page, showcasing the highest-scoring planet.
+    Shows an index/landing page, showcasing the highest-scoring planet (if any).
     GET: Renders the page.
     '''
-    mvp_planet = get_mvps(Planet)[0]
+    mvp_planet = None
+    for attempt in range(2):
+        top = top_planet_ids()
+        if not top:
+            break
+        mvp_planet = Planet.objects.select_related(*PLANET_RELATED) \
+            .filter(id=top[0], visibility=True).first()
+        if mvp_planet is not None:
+            break
+        # The cached top planets were out of date; rebuild them
+        invalidate_top_planets()
     context = {
         'planet': mvp_planet,
     }
     return render(request, 'planet/home.html', context=context)
 
 
+@cache_view(lambda: [PLANETS, SYSTEMS])
 def leaderboard(request: HttpRequest) -> HttpResponse:
     '''
     Shows the leaderboard page, sorting all planets and systems by certain criteria.
-    GET: Renders the page.
-    POST: Posts the form used to choose the sorting method. 
+    Planets and systems are paginated separately via keyset cursors (see planet/leaderboard.py).
+    GET: Renders the page. ?choice= is the sorting method (see `LeaderboardForm`),
+         ?planets_after= and ?systems_after= are the cursors of the pages to show.
     '''
     context = {}
 
-    result = '-score'
-    if request.method == 'POST':
-        form = LeaderboardForm(request.POST)
-        if form.is_valid():
-            result = form.cleaned_data['choice']
-            if result != "name":
-                result = '-' + result
-    else:
-        form = LeaderboardForm()
+    result = 'score'
+    form = LeaderboardForm(request.GET or None)
+    if form.is_bound and form.is_valid():
+        result = form.cleaned_data['choice']
 
-    planets = get_mvps(Planet, result)
-    solars = get_mvps(SolarSystem, result)
+    try:
+        planets, planets_next = leaderboard_page(
+            Planet.objects.exclude(visibility=False).select_related(*PLANET_RELATED),
+            result, request.GET.get('planets_after'))
+        solars, solars_next = leaderboard_page(
+            SolarSystem.objects.exclude(visibility=False).select_related(*SYSTEM_RELATED),
+            result, request.GET.get('systems_after'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page')
 
     context['form'] = form
     context['planets'] = planets
     context['solars'] = solars
+    context['choice'] = result
+    context['planets_next'] = planets_next
+    context['solars_next'] = solars_next
     context['page'] = 'leaderboard'
     return render(request, 'planet/leaderboard.html',context= context)
 
+@cache_view(lambda username: [user_tag(username)])
 def view_user(request: HttpRequest, username: str) -> HttpResponse:
     '''
     Shows the profile of the user named `username`.
     GET: Renders the page.
     '''
     try:
-        user = PlanetUser.objects.get(username=username)
+        user = resolvers.get_user(username)
 
+        planets = Planet.objects.filter(user=user).select_related(*PLANET_RELATED)
+        solar = SolarSystem.objects.filter(user=user).select_related(*SYSTEM_RELATED)
         if user != request.user:
-            planets = Planet.objects.filter(user__username=username, visibility=True)
-            solar = SolarSystem.objects.filter(user__username=username, visibility=True)
-        else:
-            planets = Planet.objects.filter(user__username=username)
-            solar = SolarSystem.objects.filter(user__username=username)
+            planets = planets.filter(visibility=True)
+            solar = solar.filter(visibility=True)
 
     except (PlanetUser.DoesNotExist,Planet.DoesNotExist,SolarSystem.DoesNotExist):
         raise Http404(username)
@@ -103,7 +157,7 @@ def view_user(request: HttpRequest, username: str) -> HttpResponse:
         'solars': solar,
         'page': 'view'
     }
-    return render(request, 'planet/view_user.html', context)
+    return page_response(request, [user], lambda: render(request, 'planet/view_user.html', context))
 
 @login_required
 def delete_user(request: HttpRequest, username: str) -> HttpResponse:
@@ -111,7 +165,7 @@ def delete_user(request: HttpRequest, username: str) -> HttpResponse:
     Deletes the currently logged-in user.
     Only a logged-in user is allowed to delete its own account, so `username` must match `request.user.username`.
     GET: Shows the "confirm deletion" form
-    POST: Deletes the user, his planets, his solar systems and the planets in his
+    POST: Deletes the user, his planets, comments, solar systems and the planets in his
           solar systems (even if they are by other users). Returns an error if the
           name does not match.
     '''
@@ -128,23 +182,12 @@ def delete_user(request: HttpRequest, username: str) -> HttpResponse:
                 post_url=reverse('delete_user', args=[username]))
         else:
             # POST
-            u = PlanetUser.objects.get(username=request.user.username)
-            planets = Planet.objects.filter(user__username=username)
-            solars = SolarSystem.objects.filter(user__username=username)
-            for planet in planets:
-                planet.delete()
-            for solar in solars:
-                system_planet = Planet.objects.filter(solarSystem__id= solar.id)
-                for planet in system_planet:
-                    planet.delete()
-                solar.delete()
-            if u.avatar:
-                os.remove(u.avatar.path)
-            u.delete()
+            # (In a single transaction; see planet/deletion.py)
+            deletion.delete_user(resolvers.get_user(request.user.username))
 
     except Exception as e:
+        logger.error(f'Could not delete user {username}: {repr(e)}')
         message = 'A fleet of enemy has intercepted your message and refuses to surrender it\n So please try again'
-        message += e
         return render_error(request, message)
 
     return redirect('home')
@@ -158,7 +201,7 @@ def delete_system(request: HttpRequest, username: str, systemname: str) -> HttpR
     POST: Deletes his solar system and the planets in it
     '''
     try:
-        solar = SolarSystem.objects.get(name=systemname)
+        solar = resolvers.get_system(username, systemname, SolarSystem.objects.select_related('user'))
         if request.user.username != solar.user.username:
             message = 'You tried to destroy ' + systemname + ', but it\'s not yours >:('
             return render_error(request, message)
@@ -171,14 +214,11 @@ def delete_system(request: HttpRequest, username: str, systemname: str) -> HttpR
                 post_url=reverse('delete_system', args=[username, systemname]))
         else:
             # POST
-            planets = Planet.objects.filter(solarSystem__name=systemname)
-            for planet in planets:
-                planet.delete()
-            solar.delete()
+            deletion.delete_system(solar)
 
     except Exception as e:
+        logger.error(f'Could not delete system {systemname}: {repr(e)}')
         message = 'A fleet of enemy has intercepted your message and refuses to surrender it\n So please try again'
-        #message += e
         return render_error(request, message)
 
     return redirect('home')
@@ -190,12 +230,10 @@ def delete_planet(request: HttpRequest, username: str, systemname: str, planetna
     Deletes the current planet.
     Only a logged-in user is allowed to delete its own planet, so `username` must match `request.user.username`.
     GET: Renders the "confirm deletion" form
-    POST: Deletes the user, his planets, his solar systems and the planets in his
-          solar systems (even if they are by other users). Returns an error if the
-          name does not match.
+    POST: Deletes the planet, its comments and texture, updating the scores of its solar system.
     '''
     try:
-        planet = Planet.objects.get(name=planetname)
+        planet = resolvers.get_planet(username, systemname, planetname, Planet.objects.select_related('user'))
         if request.user.username != planet.user.username:
             message = 'A hacker discovered you tried to get ' + \
                 planetname + ' destroyed and now threatens to blackmail you'
@@ -246,6 +284,7 @@ def edit_user(request: HttpRequest, username: str) -> HttpResponse:
     return render(request, 'planet/edit_user.html', context)
 
 
+@cache_view(lambda username, systemname: [system_tag(username, systemname)])
 def view_system(request: HttpRequest, username: str, systemname: str) -> HttpResponse:
     '''
     Renders some information and the list of planets contained in a solar system.
@@ -253,20 +292,24 @@ def view_system(request: HttpRequest, username: str, systemname: str) -> HttpRes
     GET: Renders the page.
     '''
     try:
-        system = SolarSystem.objects.get(name=systemname, user__username=username)
+        system = resolvers.get_system(username, systemname, SolarSystem.objects.select_related(*SYSTEM_RELATED))
         if request.user != system.user and not system.visibility:
             return render_error(request, 'This system is private')
 
-        planets = Planet.objects.filter(solarSystem=system, visibility=True)
+        # Public planets, plus the private planets of the logged-in user
+        visible = Q(visibility=True)
         if request.user.is_authenticated:
-            planets = planets.union(Planet.objects.filter(solarSystem=system, visibility=False, user=request.user))
+            visible |= Q(user=request.user)
+        planets = Planet.objects.filter(visible, solarSystem=system).select_related(*PLANET_RELATED)
 
     except SolarSystem.DoesNotExist:
         raise Http404()
 
-    return render(request, 'planet/view_system.html', {'system': system, 'planets': planets })
+    return page_response(request, [system],
+                         lambda: render(request, 'planet/view_system.html', {'system': system, 'planets': planets}))
 
 
+@cache_view(lambda username, systemname, planetname: [planet_tag(username, systemname, planetname)])
 def view_planet(request: HttpRequest, username: str, systemname: str, planetname: str) -> HttpResponse:
     '''
     Renders a 3D view of a specific planet, with a form to post comments and ratings plus share the page.
@@ -276,10 +319,13 @@ def view_planet(request: HttpRequest, username: str, systemname: str, planetname
 
     GET: Renders `editor.html` in readonly mode; the camera can be rotated/zoomed but painting is not possible.
          Renders `comments.html` in read/write mode; comments can be posted.
+         Comments are shown newest first, a page at a time; ?comments_after= is the keyset cursor
+         of the page to show (see planet/leaderboard.py).
     POST: Post the comment form.
     '''
     try:
-        planet = Planet.objects.get(name=planetname, solarSystem__user__username=username, solarSystem__name=systemname)
+        planet = resolvers.get_planet(username, systemname, planetname,
+                                      Planet.objects.select_related(*PLANET_RELATED))
         solarSystem = planet.solarSystem
     except Planet.DoesNotExist:
         raise Http404()
@@ -288,7 +334,6 @@ def view_planet(request: HttpRequest, username: str, systemname: str, planetname
         return render_error(request, 'This planet is private')
 
     context = {
-        'comments': Comment.objects.filter(planet=planet),
         'planet': planet,
         'this_page': HOST + request.path, # Required by social media buttons
     }
@@ -298,14 +343,11 @@ def view_planet(request: HttpRequest, username: str, systemname: str, planetname
         if request.method == 'POST':  # POST: upload the posted comment
             form = CommentForm(request.POST)
 
-            #If there is already a comment for this planet with this user name, modify existing comment
-            preexisting = Comment.objects.filter(planet=planet, user=request.user)
-            if preexisting.count() > 0:
-                form.instance = preexisting[0]
-
             if form.is_valid():
+                # Commit to DB (modifying the existing comment of the user on this planet, if any).
+                # This will also modify the ratings for the parent solar system and planet.
                 comment = form.save(request.user,planet)
-                comment.save()  # Commit to DB. This will also modify the ratings for the parent solar system and planet.
+                planet.refresh_from_db(fields=Planet.SUMMARY_FIELDS)
 
         else:
             # GET: Display an empty comment form
@@ -316,7 +358,17 @@ def view_planet(request: HttpRequest, username: str, systemname: str, planetname
         # No comment form for logged-out users
         context['comment_form'] = None
 
-    return render(request, 'planet/view_planet.html', context=context)
+    def render_page() -> HttpResponse:
+        # (The comments are only fetched if the page is rendered)
+        try:
+            context['comments'], context['comments_next'] = keyset_page(
+                Comment.objects.filter(planet=planet).select_related('user'), ('-id',),
+                request.GET.get('comments_after'), settings.COMMENTS_PAGE_SIZE)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid page')
+        return render(request, 'planet/view_planet.html', context=context)
+
+    return page_response(request, [planet], render_page)
 
 @login_required
 def edit_planet(request: HttpRequest, username: str, systemname: str, planetname: str) -> HttpResponse:
@@ -331,7 +383,7 @@ def edit_planet(request: HttpRequest, username: str, systemname: str, planetname
     POST: Post the modified planet texture (done via AJAX from editor.js)
     '''
     try:
-        planet = Planet.objects.get(name=planetname, solarSystem__user__username=username, solarSystem__name=systemname)
+        planet = resolvers.get_planet(username, systemname, planetname)
     except Planet.DoesNotExist:
         raise Http404()
 
@@ -340,15 +392,51 @@ def edit_planet(request: HttpRequest, username: str, systemname: str, planetname
 
     if request.method == 'POST':
         # POST: upload the newly-edited image
-        # Expects a {data: "<base64-encoded image from Canvas>"} in the POST request
-        # FIXME(Paolo): Resize image if needed, reject wrongly-sized images!
+        # Expects either the whole image from the Canvas as a `texture` file, or
+        # only the tiles that were edited as `tile_<x>_<y>` files in the POST request
+        # Uploads are checked from their header before being decoded (see planet/uploads.py)
         logger.debug(f'Planet{planet.id}: saving texture...')
         try:
             # See the AJAX request in editor.js:onSave()
-            planet.texture.save(f'{planet.id}.jpg', request.FILES['texture'])
-            planet.save()
-            logger.debug(f'Planet{planet.id}: texture saved')
+            # Resizing and thumbnail generation are queued by `Planet.save()` (see planet/jobs.py)
+            if 'texture' in request.FILES:
+                # (Stored as uploaded; it is only re-encoded if it is not a full-size JPEG)
+                uploads.validate_texture(request.FILES['texture'], Planet.TEXTURE_SIZE, Planet.TEXTURE_TILE_SIZE)
+                planet.texture.save(f'{planet.id}.jpg', request.FILES['texture'], save=False)
+                planet.save(update_fields=TEXTURE_FIELDS)
+            else:
+                tiles = []
+                for key, tile_file in request.FILES.items():
+                    match = TILE_KEY_RE.match(key)
+                    if not match:
+                        raise ValueError(f'Unexpected file: {key}')
+                    uploads.sniff_image(tile_file)
+                    tiles.append((int(match.group(1)), int(match.group(2)), tile_file.read()))
+                if not tiles:
+                    raise ValueError('No texture or tiles uploaded')
+
+                for attempt in range(TILE_SAVE_ATTEMPTS):
+                    # (Decoded and re-encoded in the process pool, see planet/jobs.py; without
+                    # holding a lock, as it takes a while)
+                    texture_name = planet.texture.name
+                    texture = jobs.composite_tiles(texture_name, tiles)
+                    with transaction.atomic():
+                        # Lock the planet (an immediate transaction on SQLite, see WadThePlanet/backends/sqlite3;
+                        # a row lock elsewhere), and only save if no other save changed the texture meanwhile,
+                        # so that concurrent saves do not overwrite each other's tiles
+                        planet = Planet.objects.select_for_update().get(id=planet.id)
+                        if planet.texture.name == texture_name:
+                            planet.texture.save(f'{planet.id}.jpg', ContentFile(texture), save=False)
+                            planet.save(update_fields=TEXTURE_FIELDS)
+                            break
+                    logger.debug(f'Planet{planet.id}: texture changed while saving tiles, compositing them again')
+                else:
+                    return HttpResponse('The texture keeps changing, try again', status=409)
+            logger.debug(f'Planet{planet.id}: texture saved, processing queued')
             return HttpResponse('saved')
+        except ValidationError as e:
+            logger.info(f'Planet{planet.id}: rejected texture upload: {e.messages[0]}')
+            return HttpResponseBadRequest(e.messages[0])
         except Exception as e:
             logger.error(f'Planet{planet.id}: error saving texture: {repr(e)}')
             return HttpResponseBadRequest('error')
@@ -404,14 +492,17 @@ def create_planet(request: HttpRequest, username: str, systemname: str) -> HttpR
     if request.method == 'POST':
         form = PlanetForm(request.POST)
         if form.is_valid():
-            system = SolarSystem.objects.get(user__username=username, name=systemname)
+            try:
+                system = resolvers.get_system(username, systemname, SolarSystem.objects.select_related('user'))
+            except SolarSystem.DoesNotExist:
+                raise Http404()
             if Planet.objects.filter(solarSystem=system, name=form.cleaned_data['name']).count() > 0:
                 messages.error(request, 'A planet with the same name already exists in the solar system')
             else:
                 planet = form.save(commit=False)
                 planet.user = request.user
                 planet.solarSystem = system
-                planet.texture = form.generate_texture(planet.name)
+                planet.texture.save(f'{planet.name}.jpg', form.generate_texture(), save=False)
                 planet.score = 0
                 planet.save()
                 return redirect('view_planet',
@@ -475,7 +566,7 @@ def search(request: HttpRequest) -> HttpResponse:
     Searchs for users, systems or planets. The search query is in ?query=
     GET: Renders the search form.
     '''
-    planets, systems, users = run_query(request.GET['query'].strip())
+    planets, systems, users = run_query(request.GET.get('query', '').strip())
     context = {
         'planets': planets,
         'systems': systems,
@@ -483,6 +574,46 @@ def search(request: HttpRequest) -> HttpResponse:
     }
     return render(request, 'planet/search.html', context=context)
 
+def serve_media(request: HttpRequest, path: str) -> HttpResponse:
+    '''
+    Serves the uploaded media (during development).
+    Textures are stored by content hash (see planet/storage.py), so their URLs (and those of their
+    thumbnails) always point to the same content, and browsers may cache them for good; except while
+    the texture is being processed (`?processing`), as it may still be resized in place.
+    Range requests (ex. for tile pyramids) get the whole file here; editor.js copes with either.
+    GET: Returns the file at `path` in MEDIA_ROOT; or a 304 Not Modified if the client's copy is current.
+    '''
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if response.status_code == 200 and path.startswith(IMMUTABLE_MEDIA_DIRS) and 'processing' not in request.GET:
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        # (Revalidated with Last-Modified; ex. avatars are overwritten in place)
+        patch_cache_control(response, no_cache=True)
+    return response
+
+def search_suggest(request: HttpRequest) -> JsonResponse:
+    '''
+    Search-as-you-type suggestions for the search box. The search query is in ?query=
+    GET: Returns the best matching planets, systems and users as JSON (see `webhose_search.suggest()`).
+    '''
+    suggestions = suggest(request.GET.get('query', ''), settings.SEARCH_SUGGESTIONS_COUNT)
+    response = JsonResponse(suggestions)
+    # Let browsers reuse the suggestions for a bit, too
+    patch_cache_control(response, max_age=settings.SEARCH_SUGGESTIONS_MAX_AGE)
+    return response
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    '''
+    Exports the request metrics of this server process (see planet/metrics.py) for Prometheus.
+    Only for staff users and requests from `settings.INTERNAL_IPS`.
+    GET: Returns the metrics in the Prometheus text format.
+    '''
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden('Metrics are only available internally')
+    response = HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    patch_cache_control(response, no_store=True)
+    return response
+
 @login_required
 def user_logout(request):
     '''
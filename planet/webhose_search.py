@@ -1,23 +1,252 @@
-import os
-import django
+import hashlib
+import logging
+import re
+from typing import Dict, Iterable, List, Tuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, router
+from django.urls import reverse
+from planet.caching import LRUCache
 from planet.models import Planet, SolarSystem, PlanetUser
-from typing import Iterable, Tuple
 
-def run_query(search_terms: Iterable[str], count: int = 100) -> Tuple:
+
+# ======================== Search index ========================================
+# On SQLite, planets, solar systems and users are indexed in a FTS5 virtual
+# table, kept in sync by the signal handlers in planet/models.py. Each indexed
+# object has a `rowid` computed from its kind and id (see `_rowid()`).
+# Other databases fall back to (unindexed) substring matching.
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'planet_search'
+'''The name of the FTS5 table containing the search index.'''
+
+KINDS = ['planet', 'system', 'user']
+'''The kinds of objects in the search index.'''
+
+EXCLUDED_USERS = ['superuser']
+'''Usernames that never show up in search results.'''
+
+
+SEARCHABLE_FIELDS = {
+    'planet': ('name', 'visibility'),
+    'system': ('name', 'description', 'visibility'),
+    'user': ('username',),
+}
+'''The fields of each kind of object that affect the search results.'''
+
+
+def _rowid(kind: str, object_id: int) -> int:
+    return object_id * len(KINDS) + KINDS.index(kind)
+
+
+def _kind_of(instance) -> str:
+    return KINDS[[Planet, SolarSystem, PlanetUser].index(type(instance))]
+
+
+def searchable_state(instance) -> Tuple:
+    '''Returns the values of the `SEARCHABLE_FIELDS` of `instance`, to tell if
+    they were changed. Deferred fields are not loaded (they show up as None).'''
+    return tuple(instance.__dict__.get(field) for field in SEARCHABLE_FIELDS[_kind_of(instance)])
+
+
+def index_available(using: str = DEFAULT_DB_ALIAS) -> bool:
+    '''Returns True if the search index can be used on the given database.'''
+    return connections[using].vendor == 'sqlite'
+
+
+def create_index(using: str = DEFAULT_DB_ALIAS):
+    '''(Re)creates the search index on the given database and fills it with all
+    searchable objects.'''
+    if not index_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+        cursor.execute(f'CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5('
+                       'kind UNINDEXED, name, description, '
+                       "tokenize = 'unicode61')")
+    for model in (Planet, SolarSystem, PlanetUser):
+        update_index(model.objects.using(using).all(), using)
+
+
+def update_index(instances: Iterable, using: str = DEFAULT_DB_ALIAS):
+    '''Adds, updates or removes the given planets/systems/users to/from the index,
+    depending on whether they are (still) searchable or not.'''
+    if not index_available(using):
+        return
+    removed, added = [], []
+    for instance in instances:
+        kind = _kind_of(instance)
+        rowid = _rowid(kind, instance.id)
+        removed.append((rowid,))
+        if kind == 'user':
+            if instance.username not in EXCLUDED_USERS:
+                added.append((rowid, kind, instance.username, ''))
+        elif instance.visibility:
+            added.append((rowid, kind, instance.name, getattr(instance, 'description', '')))
+
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', removed)
+        cursor.executemany(f'INSERT INTO {SEARCH_TABLE} (rowid, kind, name, description) '
+                           'VALUES (%s, %s, %s, %s)', added)
+
+
+def remove_from_index(instance, using: str = DEFAULT_DB_ALIAS):
+    '''Removes the given planet/system/user from the index.'''
+    if not index_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s',
+                       [_rowid(_kind_of(instance), instance.id)])
+
+
+def remove_ids_from_index(model: 'Model', ids: Iterable[int], using: str = DEFAULT_DB_ALIAS):
+    '''Removes the planets/systems/users (depending on `model`) with the given ids
+    from the index; for bulk deletions, which do not send `post_delete` signals.'''
+    if not index_available(using):
+        return
+    kind = KINDS[[Planet, SolarSystem, PlanetUser].index(model)]
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s',
+                           [(_rowid(kind, id),) for id in ids])
+
+
+# ======================== Queries =============================================
+
+
+def _match_expression(search_terms: str) -> str:
+    '''Converts the user's search terms to a FTS5 query, where each word is
+    matched as a prefix (ex. `ma sys` => `"ma"* "sys"*`).'''
+    words = re.findall(r'\w+', search_terms.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _search_index(match: str, count: int) -> Tuple[List, List, List]:
+    '''Returns the ids of the best `count` planets, systems and users for `match`.'''
+    ids = {kind: [] for kind in KINDS}
+    # (Raw SQL is not routed; read from where the planets are read from, ex. the replica)
+    with connections[router.db_for_read(Planet)].cursor() as cursor:
+        # Rank results with BM25, with matches in names weighting more than
+        # those in descriptions; then keep the best `count` of each kind.
+        cursor.execute(
+            f'SELECT kind, rowid FROM ('
+            f'    SELECT kind, rowid, ROW_NUMBER() OVER ('
+            f'        PARTITION BY kind ORDER BY bm25({SEARCH_TABLE}, 0.0, 10.0, 1.0)) AS n'
+            f'    FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s'
+            f') WHERE n <= %s ORDER BY n', [match, count])
+        for kind, rowid in cursor.fetchall():
+            ids[kind].append(rowid // len(KINDS))
+    return ids['planet'], ids['system'], ids['user']
+
+
+def _in_order(queryset, ids: List[int]) -> List:
+    '''Fetches the objects with the given ids from queryset, preserving the order of `ids`.'''
+    if not ids:
+        return []
+    objects = queryset.in_bulk(ids)
+    return [objects[id] for id in ids if id in objects]
+
+
+def _run_query_fallback(search_terms: str, count: int) -> Tuple:
     # Find planets that are visible and contain search term in their name
     found_planets = Planet.objects.all().exclude(
-        visibility=False).filter(name__contains=search_terms)
-    # Find solar systems that with search term in the name
+        visibility=False).filter(name__contains=search_terms).select_related('user', 'solarSystem__user')
+    # Find solar systems that with search term in the name or description
     found_systems = SolarSystem.objects.all().exclude(
-        visibility=False).filter(name__contains=search_terms)
-    # Find search term in solar system description
-    system_descriptions = SolarSystem.objects.all().exclude(
+        visibility=False).filter(name__contains=search_terms) | SolarSystem.objects.all().exclude(
         visibility=False).filter(description__contains=search_terms)
+    found_systems = found_systems.select_related('user')
 
     # Find matching user names, except super user
     found_users = PlanetUser.objects.all().exclude(
-        username="superuser").filter(username__contains=search_terms)
+        username__in=EXCLUDED_USERS).filter(username__contains=search_terms)
+
+    return found_planets[:count], found_systems[:count], found_users[:count]
+
+
+def run_query(search_terms: str, count: int = 100) -> Tuple:
+    '''Searches for (visible) planets, solar systems and users matching `search_terms`;
+    returns the best `count` of each kind, sorted by relevance.'''
+    if not index_available():
+        return _run_query_fallback(search_terms, count)
+
+    match = _match_expression(search_terms)
+    if not match:
+        return [], [], []
+    try:
+        planet_ids, system_ids, user_ids = _search_index(match, count)
+    except DatabaseError as e:
+        # Ex. the index was not created yet (run `manage.py migrate`)
+        logger.error(f'Search index unavailable: {repr(e)}')
+        return _run_query_fallback(search_terms, count)
+
+    return (_in_order(Planet.objects.select_related('user', 'solarSystem__user'), planet_ids),
+            _in_order(SolarSystem.objects.select_related('user'), system_ids),
+            _in_order(PlanetUser.objects.all(), user_ids))
+
+
+# ======================== Suggestions =========================================
+# Search-as-you-type suggestions are cached both in-process (LRU) and in the
+# shared Django cache, keyed by normalized query. All cached suggestions are
+# invalidated at once when any searchable field changes, by bumping a
+# "generation" counter that is part of the keys.
+
+SUGGESTIONS_GENERATION_KEY = 'search-suggestions-generation'
+'''The (shared) cache key of the current suggestions generation.'''
+
+_suggestions_lru = LRUCache(max_size=1024)
+'''In-process cache of (generation, query, count) => suggestions.'''
+
+
+def normalize_query(search_terms: str) -> str:
+    '''Normalizes the search terms, so that equivalent queries share cache entries.'''
+    return ' '.join(re.findall(r'\w+', search_terms.lower()))
+
+
+def invalidate_suggestions():
+    '''Invalidates all cached suggestions (in all processes).'''
+    try:
+        cache.incr(SUGGESTIONS_GENERATION_KEY)
+    except ValueError:
+        # Key missing (ex. evicted); any value different from the default 0 will do
+        cache.set(SUGGESTIONS_GENERATION_KEY, 1, timeout=None)
+
+
+def suggest(search_terms: str, count: int) -> Dict:
+    '''Returns the best `count` planets, systems and users matching `search_terms`,
+    as a JSON-serializable dict of {kind: [{name, url, ...}]}.'''
+    query = normalize_query(search_terms)
+    if not query:
+        return {'planets': [], 'systems': [], 'users': []}
+
+    generation = cache.get(SUGGESTIONS_GENERATION_KEY, 0)
+    key = (generation, query, count)
+    suggestions = _suggestions_lru.get(key)
+    if suggestions is not None:
+        return suggestions
 
-    # Combine solar systems name and description and remove duplicates
-    found_systems.union(system_descriptions).distinct()
-    return found_planets, found_systems, found_users
+    query_hash = hashlib.sha1(query.encode()).hexdigest()
+    shared_key = f'search-suggestions:{generation}:{count}:{query_hash}'
+    suggestions = cache.get(shared_key)
+    if suggestions is None:
+        planets, systems, users = run_query(query, count)
+        suggestions = {
+            'planets': [{
+                'name': planet.name,
+                'system': planet.solarSystem.name,
+                'url': reverse('view_planet', args=[
+                    planet.solarSystem.user.username, planet.solarSystem.name, planet.name]),
+            } for planet in planets],
+            'systems': [{
+                'name': system.name,
+                'user': system.user.username,
+                'url': reverse('view_system', args=[system.user.username, system.name]),
+            } for system in systems],
+            'users': [{
+                'name': user.username,
+                'url': reverse('view_user', args=[user.username]),
+            } for user in users],
+        }
+        cache.set(shared_key, suggestions, settings.SEARCH_SUGGESTIONS_TIMEOUT)
+    _suggestions_lru.set(key, suggestions)
+    return suggestions
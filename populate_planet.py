@@ -1,9 +1,11 @@
 
 #!/usr/bin/env python3
 
+import argparse
 import random
 import string
-from PIL import Image, ImageDraw
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 import os
@@ -12,42 +14,50 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "WadThePlanet.settings")
 import django
 django.setup()
 from planet.models import PlanetUser, Planet, SolarSystem,Comment
+from planet import textures, scores, webhose_search
+from planet.storage import texture_storage
+from planet.texturegen import generate_texture_jpeg
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile, File
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
 
 
 
 
-#Copy the files over to the media destination
+#Store the files in the texture storage (by content, see planet/storage.py),
 #to avoid deleting pictures when deleting database
-import shutil
 self_path = os.path.abspath(os.path.dirname(__file__))
 src = os.path.join(self_path,'_populationmedia/')
-dest = os.path.join(self_path,'media/planets/')
-src_files = os.listdir(src)
-for file_name in src_files:
+population_textures = {}  # File name in _populationmedia => texture name
+for file_name in os.listdir(src):
     full_file_name = os.path.join(src, file_name)
     if (os.path.isfile(full_file_name)):
-        shutil.copy(full_file_name, dest)
+        with open(full_file_name, 'rb') as f:
+            population_textures[file_name] = texture_storage.save('planets/' + file_name, File(f))
 
 
 def populate_old():
 
     planets1 = [{"name": "planet1",
-                 "texture": 'planets/texture1.jpeg'},
+                 "texture": population_textures['texture1.jpeg']},
 
                 {"name": "planet2",
-                 "texture": 'planets/texture2.jpeg'},
+                 "texture": population_textures['texture2.jpeg']},
                 ]
 
     planets2 = [{"name": "planet3",
-                 "texture": 'planets/texture3.jpeg'},
+                 "texture": population_textures['texture3.jpeg']},
 
                 ]
 
     planets3 = [{"name": "planet4",
-                 "texture": 'planets/texture4.jpeg'},
+                 "texture": population_textures['texture4.jpeg']},
                 ]
 
-    moon = [{"name": "Moon", "texture": 'planets/texture1.jpeg', }
+    moon = [{"name": "Moon", "texture": population_textures['texture1.jpeg'], }
             ]
 
     SolarSystem1 = [{
@@ -125,30 +135,8 @@ def populate(number):
                 add_comment(people, planet)
 
 def generate_texture(name):
-    img = Image.new('RGB', (2048, 2048), (
-        random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-    draw = ImageDraw.Draw(img)
-    draw.rectangle((random.randint(0, 2048), random.randint(0, 2048), random.randint(
-        0, 2048), random.randint(0, 2048)), fill=(
-        random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-    draw.pieslice((random.randint(0, 2048), random.randint(0, 2048), random.randint(
-        0, 2048), random.randint(0, 2048)), random.randint(0, 360), random.randint(0, 360), fill=(
-        random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-    draw.ellipse((random.randint(0, 2048), random.randint(0, 2048), random.randint(
-        0, 2048), random.randint(0, 2048)), fill=(
-        random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-    pos = []
-    for i in range(random.randint(3,10)):
-        pos.append((random.randint(0, 2048), random.randint(0, 2048)))
-    draw.polygon(pos, fill=(
-        random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-
-    rel_path = 'planets/'+name+'.png'
-    abs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media', rel_path)
-    if os.path.exists(abs_path):
-        os.unlink(abs_path)
-    img.save(abs_path,'JPEG')
-    return rel_path  # Otherwise weird things may happen
+    data = generate_texture_jpeg(Planet.TEXTURE_SIZE, seed=random.getrandbits(32))
+    return texture_storage.save('planets/'+name+'.jpg', ContentFile(data))
 
 
 #helper functions
@@ -187,7 +175,103 @@ def create_super_user(username):
     u = PlanetUser.objects.create_superuser(username=username, email=email, password="superuser")
 
 
+#bulk mode, for load-testing datasets
+#Rows are inserted with bulk_create() in batches, with explicit ids (so that no
+#row needs to be read back); scores, rankings and the search index are computed
+#in one pass at the end. Textures are rendered in a process pool and stored by
+#content, so a small set of textures is shared by all planets.
+
+def render_texture(seed):
+    #Renders the texture for `seed` (in a worker process) and stores it, along with
+    #its thumbnails, in the texture storage; returns its name
+    content = ContentFile(generate_texture_jpeg(Planet.TEXTURE_SIZE, seed=seed))
+    name = texture_storage.content_name('planets/generated.jpg', content)
+    if not texture_storage.exists(name):
+        texture_storage.save('planets/generated.jpg', content)
+        textures.process_texture(name, Planet.TEXTURE_SIZE)
+    return name
+
+
+def next_ids(model, count):
+    #Reserves `count` consecutive ids for new rows of `model`
+    start = (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+    return range(start, start + count)
+
+
+def random_words(rng, count):
+    return " ".join("".join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(2,10)))
+                    for j in range(count))
+
+
+def populate_bulk(users, seed=0, texture_count=64, comments_per_user=10, workers=None, batch_size=None):
+    rng = random.Random(seed)
+    started = time.time()
+    os.makedirs(os.path.join(settings.MEDIA_ROOT, 'planets'), exist_ok=True)
+
+    print(f"Rendering {texture_count} textures")
+    texture_seeds = [rng.getrandbits(64) for i in range(texture_count)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        texture_names = list(executor.map(render_texture, texture_seeds))
+
+    with transaction.atomic():
+        print(f"Generating {users} users")
+        #(Hashing the password is slow; all users share it)
+        password = make_password("password")
+        user_objs = [PlanetUser(id=id, username="".join(rng.choice(string.ascii_lowercase) for i in range(6)) + str(id),
+                                email=f"user{id}@hotmail.com", password=password)
+                     for id in next_ids(PlanetUser, users)]
+        PlanetUser.objects.bulk_create(user_objs, batch_size=batch_size)
+
+        system_objs = []
+        for user, id in zip([u for u in user_objs for i in range(rng.randint(2,5))], next_ids(SolarSystem, 5 * users)):
+            system_objs.append(SolarSystem(id=id, user=user, name="SolarSystem"+str(id),
+                                           description=random_words(rng, 15)[:160]))
+        print(f"Generating {len(system_objs)} solar systems")
+        SolarSystem.objects.bulk_create(system_objs, batch_size=batch_size)
+
+        planet_objs = []
+        for system, id in zip([s for s in system_objs for i in range(rng.randint(2,5))], next_ids(Planet, 5 * len(system_objs))):
+            planet_objs.append(Planet(id=id, name="planet"+str(id), user=system.user, solarSystem=system,
+                                      texture=rng.choice(texture_names), visibility=rng.random() > 0.05))
+        print(f"Generating {len(planet_objs)} planets")
+        Planet.objects.bulk_create(planet_objs, batch_size=batch_size)
+
+        comment_objs = []
+        for user in user_objs:
+            for planet in rng.sample(planet_objs, min(comments_per_user, len(planet_objs))):
+                comment_objs.append(Comment(planet=planet, user=user, comment=random_words(rng, 3), rating=rng.randint(1,5)))
+        print(f"Generating {len(comment_objs)} comments")
+        Comment.objects.bulk_create(comment_objs, batch_size=batch_size)
+
+        #The ids were set explicitly, so the DB sequences (if any) need to catch up
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [PlanetUser, SolarSystem, Planet]):
+                cursor.execute(sql)
+
+        print("Computing scores and search index")
+        scores.recompute_scores()
+        webhose_search.create_index()
+
+    print(f"Done in {time.time() - started:.1f}s")
+
+
 #start execution here
 
 if __name__ == '__main__':
-    populate(5)
+    parser = argparse.ArgumentParser(description='Populates the database with test data. '
+                                     'Without --users, adds a small hand-made dataset plus 5 random users.')
+    parser.add_argument('--users', type=int, help='Bulk mode: number of random users to add '
+                        '(each with 2-5 solar systems with 2-5 planets each)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (bulk mode)')
+    parser.add_argument('--textures', type=int, default=64, help='Number of distinct textures to render (bulk mode)')
+    parser.add_argument('--comments', type=int, default=10, help='Comments per user (bulk mode)')
+    parser.add_argument('--workers', type=int, default=None, help='Processes rendering textures (bulk mode; default: all CPUs)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Rows per INSERT (bulk mode; default: as many as the database allows)')
+    args = parser.parse_args()
+
+    if args.users is None:
+        populate(5)
+    else:
+        populate_bulk(args.users, seed=args.seed, texture_count=args.textures,
+                      comments_per_user=args.comments, workers=args.workers, batch_size=args.batch_size)
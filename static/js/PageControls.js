@@ -34,4 +34,49 @@ $(function() {
             }
         }
     });
+
+    // Search-as-you-type suggestions for the search box
+    var SUGGESTIONS_DELAY = 150; // (ms) Only query the server when the user stops typing
+    var suggestionsCache = {}; // Normalized query => suggestions, as returned by the server
+    var suggestionsTimer = null;
+
+    function showSuggestions(suggestions) {
+        var dropdown = $('#search-suggestions').empty();
+        var groups = [['planets', 'fa-globe'], ['systems', 'fa-sun'], ['users', 'fa-user-astronaut']];
+        groups.forEach(function (group) {
+            suggestions[group[0]].forEach(function (item) {
+                var link = $('<a class="dropdown-item">').attr('href', item.url);
+                link.append($('<i class="fas mr-2">').addClass(group[1])).append($('<span>').text(item.name));
+                dropdown.append(link);
+            });
+        });
+        dropdown.toggleClass('show', dropdown.children().length > 0);
+    }
+
+    $('#search-input').on('input', function () {
+        var input = $(this);
+        var query = input.val().trim().toLowerCase().replace(/\s+/g, ' ');
+        clearTimeout(suggestionsTimer);
+        if (!query) {
+            $('#search-suggestions').removeClass('show');
+            return;
+        }
+        if (query in suggestionsCache) {
+            showSuggestions(suggestionsCache[query]);
+            return;
+        }
+        suggestionsTimer = setTimeout(function () {
+            $.getJSON(input.data('suggest-url'), {query: query}, function (suggestions) {
+                suggestionsCache[query] = suggestions;
+                // Only show them if the user did not type something else meanwhile
+                if (input.val().trim().toLowerCase().replace(/\s+/g, ' ') === query) {
+                    showSuggestions(suggestions);
+                }
+            });
+        }, SUGGESTIONS_DELAY);
+    });
+    $('#search-input').on('blur', function () {
+        // (Delayed, otherwise clicks on the suggestions would be lost)
+        setTimeout(function () { $('#search-suggestions').removeClass('show'); }, 200);
+    });
 });
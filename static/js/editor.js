@@ -11,6 +11,13 @@ var clock;
 
 var textureCanvas; // JQuery selector to the <canvas> containing the painted texture
 const TEXTURE_SIZE = 2048; // In pixels, must be power-of-two
+const TILE_SIZE = 256; // In pixels; only the tiles that were painted on are uploaded on save
+const N_TILES = TEXTURE_SIZE / TILE_SIZE; // (Per side)
+var dirtyTiles = {}; // "x,y" => [x, y] for each tile that was painted on since the last save
+var pyramid = null; // Viewer only: header of the texture's tile pyramid, once loaded (see `loadPyramidTexture()`)
+var pyramidDrawnSize = 0; // Size (in pixels) of the largest pyramid level drawn so far
+var pyramidLoading = false; // Is a pyramid level being loaded?
+const PYRAMID_HEADER_GUESS = 4096; // In bytes; read along with the start of a tile pyramid (enough for its header)
 
 if (!brush) {
     var brush = {
@@ -66,6 +73,7 @@ function setup() {
     scene.add(camera);
 
     cameraControls = new THREE.OrbitControls(camera, renderer.domElement);
+    cameraControls.addEventListener('change', refinePyramidTexture); // (Zooming in may need a larger texture)
     cameraControls.enabled = planetEditor.camControlsEnabled;
     if (cameraControls.enabled) {
         cameraControls.enablePan = false;
@@ -157,12 +165,161 @@ function loadInitialTexture() {
     // then set `planetMesh.material.map.needsUpdate`.
     var ctx = textureCanvas[0].getContext("2d");
     var initialPlanetImage = $('#initial-texture');
+    if (initialPlanetImage.data('pyramid-url') && !planetEditor.editingEnabled) {
+        loadPyramidTexture(initialPlanetImage);
+        return;
+    }
     $(function () { // On image loaded (document ready)
         ctx.drawImage(initialPlanetImage[0], 0, 0, textureCanvas.width(), textureCanvas.height());
         planetMesh.material.map.needsUpdate = true;
     });
 }
 
+function fetchRange(url, start, end) {
+    // Fetch bytes [start, end) of `url` with a HTTP Range request; returns a Promise
+    // resolving to an ArrayBuffer. (Servers that ignore the Range send the whole
+    // file, which is then sliced; browsers cache it, as pyramids are immutable)
+    return fetch(url, { headers: { 'Range': 'bytes=' + start + '-' + (end - 1) } }).then(function (response) {
+        if (!response.ok) {
+            throw new Error(url + ': HTTP ' + response.status);
+        }
+        return response.arrayBuffer().then(function (data) {
+            return response.status == 206 ? data : data.slice(start, end);
+        });
+    });
+}
+
+function loadPyramidHeader(url) {
+    // Read the header of the tile pyramid at `url` (see planet/textures.py for the
+    // file layout); returns a Promise resolving to it, plus its `url` and `dataOffset`.
+    return fetchRange(url, 0, PYRAMID_HEADER_GUESS).then(function (data) {
+        var magic = String.fromCharCode.apply(null, new Uint8Array(data, 0, 4));
+        if (magic != 'WDPT') {
+            throw new Error(url + ': not a tile pyramid');
+        }
+        var dataOffset = 8 + new DataView(data).getUint32(4, true); // (Little-endian)
+        var headerData = dataOffset <= data.byteLength ?
+            Promise.resolve(data.slice(8, dataOffset)) : fetchRange(url, 8, dataOffset);
+        return headerData.then(function (headerBytes) {
+            var header = JSON.parse(new TextDecoder().decode(headerBytes));
+            header.url = url;
+            header.dataOffset = dataOffset;
+            return header;
+        });
+    });
+}
+
+function decodeTile(data) {
+    // Returns a Promise resolving to an Image of the given JPEG data
+    return new Promise(function (resolve, reject) {
+        var tile = new Image();
+        var url = URL.createObjectURL(new Blob([data], { type: 'image/jpeg' }));
+        tile.onload = function () {
+            URL.revokeObjectURL(url);
+            resolve(tile);
+        };
+        tile.onerror = reject;
+        tile.src = url;
+    });
+}
+
+function drawPyramidLevel(level) {
+    // Fetch all the tiles of `level` of `pyramid` with a single Range request (they are
+    // stored one after the other), then draw them, scaled up, into "texture-canvas".
+    var ctx = textureCanvas[0].getContext("2d");
+    var first = level.tiles[0], last = level.tiles[level.tiles.length - 1];
+    var start = first[0], end = last[0] + last[1];
+    var tilesPerSide = Math.ceil(level.size / pyramid.tile_size);
+    var scale = TEXTURE_SIZE / level.size;
+    return fetchRange(pyramid.url, pyramid.dataOffset + start, pyramid.dataOffset + end).then(function (data) {
+        return Promise.all(level.tiles.map(function (tile, i) {
+            return decodeTile(data.slice(tile[0] - start, tile[0] - start + tile[1])).then(function (image) {
+                var x = (i % tilesPerSide) * pyramid.tile_size, y = Math.floor(i / tilesPerSide) * pyramid.tile_size;
+                ctx.drawImage(image, x * scale, y * scale, image.width * scale, image.height * scale);
+            });
+        }));
+    }).then(function () {
+        pyramidDrawnSize = level.size;
+        planetMesh.material.map.needsUpdate = true;
+    });
+}
+
+function neededTextureSize() {
+    // The texture size (in pixels) worth drawing for the planet as currently shown:
+    // about the size of its silhouette on screen, in device pixels, as each face of
+    // the (cube-shaped) planet maps the whole texture.
+    var visibleHeight = 2.0 * camera.position.length() * Math.tan(camera.fov * Math.PI / 360.0);
+    var diameter = 2.0 / visibleHeight * renderer.domElement.height; // (The planet's radius is 1.0)
+    return Math.min(diameter, TEXTURE_SIZE);
+}
+
+function nextPyramidLevel() {
+    // The pyramid level to draw next, if any: 4 times as large as the one drawn so far
+    // (so that each step costs about as much as all previous ones), but no larger
+    // than the first one that is at least `neededTextureSize()`.
+    var needed = neededTextureSize();
+    if (pyramidDrawnSize >= needed) {
+        return null;
+    }
+    var next = null;
+    for (var i = pyramid.levels.length - 1; i >= 0; i--) { // (Smallest level first)
+        var level = pyramid.levels[i];
+        if (level.size <= pyramidDrawnSize) {
+            continue;
+        }
+        next = level;
+        if (level.size >= pyramidDrawnSize * 4 || level.size >= needed) {
+            break;
+        }
+    }
+    return next;
+}
+
+function refinePyramidTexture() {
+    // Viewer only: draw the next levels of the tile pyramid, while the planet is shown
+    // larger than those drawn so far (ex. on load, and as the camera zooms in)
+    if (!pyramid || pyramidLoading) {
+        return;
+    }
+    var level = nextPyramidLevel();
+    if (!level) {
+        return;
+    }
+    pyramidLoading = true;
+    drawPyramidLevel(level).then(function () {
+        pyramidLoading = false;
+        refinePyramidTexture();
+    }, function (error) {
+        console.error(error);
+        pyramidLoading = false; // (Retried on the next camera change)
+    });
+}
+
+function loadPyramidTexture(initialPlanetImage) {
+    // Viewer only: draw the smallest level of the texture's tile pyramid (stretched)
+    // as soon as it loads, then larger levels as needed (see `refinePyramidTexture()`).
+    // Falls back to loading the full texture image if the pyramid is unavailable.
+    var fallback = function (error) {
+        console.error(error);
+        pyramid = null;
+        var ctx = textureCanvas[0].getContext("2d");
+        initialPlanetImage.removeData('pyramid-url').off('load').on('load', function () {
+            ctx.drawImage(initialPlanetImage[0], 0, 0, TEXTURE_SIZE, TEXTURE_SIZE);
+            planetMesh.material.map.needsUpdate = true;
+        });
+        initialPlanetImage.attr('src', initialPlanetImage.data('src'));
+    };
+
+    pyramidLoading = true;
+    loadPyramidHeader(initialPlanetImage.data('pyramid-url')).then(function (header) {
+        pyramid = header;
+        return drawPyramidLevel(pyramid.levels[pyramid.levels.length - 1]);
+    }).then(function () {
+        pyramidLoading = false;
+        refinePyramidTexture();
+    }, fallback);
+}
+
 function setupTextureCanvas() {
     // Create and init `textureCanvas`, i.e. the Canvas that will hold the texture
     // painted by the user for the planet.
@@ -245,6 +402,7 @@ function onWindowResize() {
     //camera.position.multiplyScalar(camera.aspect / oldAspect);
 
     renderer.setSize(width, height);
+    refinePyramidTexture();
 }
 
 function raycastPlanet(clientX, clientY) {
@@ -276,16 +434,30 @@ function paintPlanet(clientX, clientY, updateMap) {
         planetMesh.material.map.transformUv(uv); // Transform the UV based on sampler params (repeat, flip...)
 
         var ctx = textureCanvas[0].getContext('2d');
+        var centerX = uv.x * textureCanvas.width(), centerY = uv.y * textureCanvas.height();
         ctx.beginPath();
-        ctx.arc(uv.x * textureCanvas.width(), uv.y * textureCanvas.height(),
-            brush.size, 0.0, 2.0 * Math.PI);
+        ctx.arc(centerX, centerY, brush.size, 0.0, 2.0 * Math.PI);
         ctx.fillStyle = brush.color;
         ctx.fill();
+        markDirty(centerX - brush.size, centerY - brush.size, centerX + brush.size, centerY + brush.size);
 
         planetMesh.material.map.needsUpdate = updateMap || true;
     }
 }
 
+function markDirty(minX, minY, maxX, maxY) {
+    // Marks the tiles overlapping the given rectangle (in texture pixels) as dirty
+
+    var clampTile = function (coord) {
+        return Math.min(Math.max(Math.floor(coord / TILE_SIZE), 0), N_TILES - 1);
+    };
+    for (let y = clampTile(minY); y <= clampTile(maxY); y++) {
+        for (let x = clampTile(minX); x <= clampTile(maxX); x++) {
+            dirtyTiles[x + ',' + y] = [x, y];
+        }
+    }
+}
+
 function onMouseDown(evt) {
     switch (evt.button) {
         case 0: // Left mouse button
@@ -334,20 +506,60 @@ function showAlert(msg, type, doesNotExpire) {
     }
 }
 
+function encodeTiles(tiles) {
+    // Encodes the given [x, y] tiles of `textureCanvas` to JPEG blobs; returns a
+    // Promise resolving to an array of [x, y, blob]
+    var tileCanvas = $('<canvas width="' + TILE_SIZE + '" height="' + TILE_SIZE + '">')[0];
+    var tileCtx = tileCanvas.getContext('2d');
+    return tiles.reduce(function (encoded, tile) {
+        return encoded.then(function (blobs) {
+            return new Promise(function (resolve) {
+                var x = tile[0], y = tile[1];
+                tileCtx.drawImage(textureCanvas[0], x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE,
+                    0, 0, TILE_SIZE, TILE_SIZE);
+                tileCanvas.toBlob(function (blob) {
+                    resolve(blobs.concat([[x, y, blob]]));
+                }, 'image/jpeg', 0.90); // 0.90: 90% quality
+            });
+        });
+    }, Promise.resolve([]));
+}
+
 function onSave() {
     // Editing is to be saved; do it via an AJAX POST request to the current URL.
+    // Only the tiles that were painted on are sent (as `tile_<x>_<y>` files), unless
+    // most of the texture was changed; in that case the whole texture is sent instead.
+    var tiles = Object.values(dirtyTiles);
+    if (tiles.length == 0) {
+        showAlert('Saved!', 'alert-success');
+        return;
+    }
+    dirtyTiles = {};
+
     $('#save').attr('disabled', '');
     showAlert('Saving...', 'alert-primary', true);
 
-    textureCanvas[0].toBlob(function (textureImageBlob) {
-        // After the image has been encoded to a blob, pass it as a file to a `FormData`.
-        // This will make the image appear in `request.FILES[0]` on the Django side when sent via AJAX.
-        var formData = new FormData();
-        formData.append('texture', textureImageBlob);
+    var formData = new FormData();
+    var encoded;
+    if (tiles.length > N_TILES * N_TILES / 2) {
+        encoded = new Promise(function (resolve) {
+            textureCanvas[0].toBlob(function (textureImageBlob) {
+                // After the image has been encoded to a blob, pass it as a file to a `FormData`.
+                // This will make the image appear in `request.FILES` on the Django side when sent via AJAX.
+                formData.append('texture', textureImageBlob);
+                resolve();
+            }, 'image/jpeg', 0.90); // 0.90: 90% quality
+        });
+    } else {
+        encoded = encodeTiles(tiles).then(function (tileBlobs) {
+            tileBlobs.forEach(function (tile) {
+                formData.append('tile_' + tile[0] + '_' + tile[1], tile[2]);
+            });
+        });
+    }
 
+    encoded.then(function () {
         // TODO(Paolo): Show the user that the upload is in progress
-        // TODO(Paolo): Replace alert()s with non-modal text
-
         $.ajax({
             type: 'POST',
             url: window.location.href, // POST to the current URL
@@ -365,19 +577,26 @@ function onSave() {
 
                 // Apply the newly-saved texture to initial-texture; this way the
                 // reset button will restore this saved texture
-                $('#initial-texture')[0].src = URL.createObjectURL(formData.get('texture'));
+                textureCanvas[0].toBlob(function (textureImageBlob) {
+                    $('#initial-texture')[0].src = URL.createObjectURL(textureImageBlob);
+                }, 'image/jpeg', 0.90);
             },
             error: function () {
                 showAlert('Upload error :(', 'alert-danger');
                 $('#save').removeAttr('disabled');
+                // The tiles were not saved; send them again next time
+                tiles.forEach(function (tile) {
+                    dirtyTiles[tile[0] + ',' + tile[1]] = tile;
+                });
             }
         });
-    }, 'image/jpeg', 0.90); // 0.90: 90% quality
+    });
 }
 
 function onReset() {
     // Editing cancelled; reload initial texture to `textureCanvas`
     loadInitialTexture();
+    dirtyTiles = {};
     showAlert('Reset', 'alert-warning');
 }
 